@@ -2,12 +2,18 @@
 import requests
 import html
 import string
+import threading
 
-from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote, urlsplit
 from retrying import retry
 from typing import Literal, Tuple, List
 
 from BHU.Checkpoint import bhu_checkpoint
+from BHU.Codecs import checkpoint_codec
+from BHU.RateLimit import rate_limiter, RateLimited
+from BHU.SingleFlight import single_flight
 
 import os
 
@@ -26,68 +32,90 @@ USREALESTATE_API_HEADERS = {
     "X-RapidAPI-Host": "us-real-estate.p.rapidapi.com"
 }
 
-@bhu_checkpoint(key=lambda args, kwargs: quote(args[0]) + '.pkl', 
-            work_dir='BHU/Saved Results/LocationSuggest/', prod=prod)
-@retry(stop_max_attempt_number=5)
-def get_LocationSuggest(
-        search_keyword : str, 
-        prod           : bool = prod,
-        return_all     : bool = False,
-    ) -> dict:
+# (connect, read) seconds. Without these a hung upstream hangs the worker forever.
+REQUEST_TIMEOUT = (float(os.environ.get('BHU_CONNECT_TIMEOUT', 3.05)), float(os.environ.get('BHU_READ_TIMEOUT', 20)))
+# Connections kept alive per upstream host, this should be at least the number of threads making calls.
+HTTP_POOL_SIZE = int(os.environ.get('BHU_HTTP_POOL_SIZE', 16))
+# How many pages of a property search query_url will have in flight at once.
+PAGE_CONCURRENCY = int(os.environ.get('BHU_PAGE_CONCURRENCY', 4))
+
+# How long each kind of checkpoint is good for. Estimates and searches go stale, addresses and walk scores do not
+# really change. Every namespace also gets the same disk budget, least recently used goes first.
+DAY = 24 * 60 * 60
+CHECKPOINT_TTL = {
+    'LocationSuggest' : 90 * DAY,
+    'PropertyDetail' : 30 * DAY,
+    'PropertyValue' : 7 * DAY,
+    'WalkScore' : 365 * DAY,
+    'Properties' : 7 * DAY
+}
+CHECKPOINT_MAX_BYTES = int(os.environ.get('BHU_CHECKPOINT_MAX_BYTES', 256 * 2**20))
+# In process memory tier per function, so repeat lookups during one user flow never touch the disk.
+CHECKPOINT_MEMORY_BYTES = int(os.environ.get('BHU_CHECKPOINT_MEMORY_BYTES', 16 * 2**20))
+
+_sessions = {}
+_sessions_lock = threading.Lock()
 
+def _get_session(url : str) -> requests.Session:
+    '''
+    One pooled, keep-alive session per upstream host (RapidAPI, WalkScore), shared by every call in the process,
+    so we are not paying for a new TCP + TLS handshake on every request.
+    '''
+    host = urlsplit(url).netloc
+    session = _sessions.get(host)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+        return _sessions[host]
+
+def _http_get(url : str, params : dict = None, headers : dict = None) -> requests.Response:
+    rate_limiter(url).acquire()
+    return _get_session(url).get(url, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
+
+def _retry_unless_rate_limited(e : Exception) -> bool:
+    # Trying again straight away would only be refused again.
+    return not isinstance(e, RateLimited)
+
+'''
+Each request is spelled out once below as (url, querystring, headers), and both the blocking functions here and
+the coroutines in AsyncAPI_Calls build their requests from these.
+'''
+
+def _location_suggest_request(search_keyword : str) -> Tuple[str, dict, dict]:
     url = "https://us-real-estate.p.rapidapi.com/location/suggest"
 
     querystring = {
         "input":search_keyword
     }
 
-    response = requests.request("GET", url, headers=USREALESTATE_API_HEADERS, params=querystring)
-    response_json = response.json()
-    return response_json if return_all else response_json['data'][0]
-
-@bhu_checkpoint(key=lambda args, kwargs: quote(args[0]) + '.pkl', 
-            work_dir='BHU/Saved Results/PropertyDetail/', prod=prod)
-@retry(stop_max_attempt_number=5)
-def get_PropertyDetail(
-        property_id : str,
-        prod        : bool = prod
-    ) -> dict:
+    return url, querystring, USREALESTATE_API_HEADERS
 
+def _property_detail_request(property_id : str) -> Tuple[str, dict, dict]:
     url = "https://us-real-estate.p.rapidapi.com/v2/property-detail"
 
     querystring = {
         "property_id":property_id
     }
 
-    response = requests.request("GET", url, headers=USREALESTATE_API_HEADERS, params=querystring)
-    return response.json()
+    return url, querystring, USREALESTATE_API_HEADERS
 
-@bhu_checkpoint(key=string.Template('${property_id}.pkl'), 
-            work_dir='BHU/Saved Results/PropertyValue/', prod=prod)
-@retry(stop_max_attempt_number=5)
-def get_PropertyValue(
-        property_id : str,
-        prod        : bool = prod 
-    ) -> dict:
+def _property_value_request(property_id : str) -> Tuple[str, dict, dict]:
     url = "https://us-real-estate.p.rapidapi.com/for-sale/home-estimate-value"
 
     querystring = {
         "property_id":property_id
     }
 
-    response = requests.request("GET", url, headers=USREALESTATE_API_HEADERS, params=querystring)
-    return response.json()
-
-@bhu_checkpoint(key=string.Template('${lat}_${lon}.pkl'), 
-            work_dir='BHU/Saved Results/WalkScore/', prod=prod)
-@retry(stop_max_attempt_number=5)
-def get_WalkScore(
-    address : str,
-    lat : float,
-    lon : float,
-    prod : bool = prod
-    ) -> dict:
+    return url, querystring, USREALESTATE_API_HEADERS
 
+def _walk_score_request(address : str, lat : float, lon : float) -> Tuple[str, dict, dict]:
     querystring = {
         "format":'json',
         "address":quote(address),
@@ -100,33 +128,80 @@ def get_WalkScore(
 
     url = "https://api.walkscore.com/score"
 
-    response = requests.request("GET", url, params=querystring)
-    return response.json()
+    return url, querystring, None
 
-def get_Properties(
-        parent_pid    : str,
+@single_flight()
+@bhu_checkpoint(key=lambda args, kwargs: quote(args[0]) + '.pkl', 
+            work_dir='BHU/Saved Results/LocationSuggest/', prod=prod,
+            ttl=CHECKPOINT_TTL['LocationSuggest'], max_bytes=CHECKPOINT_MAX_BYTES,
+            memory_bytes=CHECKPOINT_MEMORY_BYTES,
+            pickler=checkpoint_codec.pickler, unpickler=checkpoint_codec.unpickler)
+@retry(stop_max_attempt_number=5, retry_on_exception=_retry_unless_rate_limited)
+def get_LocationSuggest(
+        search_keyword : str, 
+        prod           : bool = prod,
+        return_all     : bool = False,
+    ) -> dict:
+
+    url, querystring, headers = _location_suggest_request(search_keyword)
+    response_json = _http_get(url, params=querystring, headers=headers).json()
+    return response_json if return_all else response_json['data'][0]
+
+@single_flight()
+@bhu_checkpoint(key=lambda args, kwargs: quote(args[0]) + '.pkl', 
+            work_dir='BHU/Saved Results/PropertyDetail/', prod=prod,
+            ttl=CHECKPOINT_TTL['PropertyDetail'], max_bytes=CHECKPOINT_MAX_BYTES,
+            memory_bytes=CHECKPOINT_MEMORY_BYTES,
+            pickler=checkpoint_codec.pickler, unpickler=checkpoint_codec.unpickler)
+@retry(stop_max_attempt_number=5, retry_on_exception=_retry_unless_rate_limited)
+def get_PropertyDetail(
+        property_id : str,
+        prod        : bool = prod
+    ) -> dict:
+
+    url, querystring, headers = _property_detail_request(property_id)
+    return _http_get(url, params=querystring, headers=headers).json()
+
+@single_flight()
+@bhu_checkpoint(key=string.Template('${property_id}.pkl'), 
+            work_dir='BHU/Saved Results/PropertyValue/', prod=prod,
+            ttl=CHECKPOINT_TTL['PropertyValue'], max_bytes=CHECKPOINT_MAX_BYTES,
+            memory_bytes=CHECKPOINT_MEMORY_BYTES,
+            pickler=checkpoint_codec.pickler, unpickler=checkpoint_codec.unpickler)
+@retry(stop_max_attempt_number=5, retry_on_exception=_retry_unless_rate_limited)
+def get_PropertyValue(
+        property_id : str,
+        prod        : bool = prod 
+    ) -> dict:
+    url, querystring, headers = _property_value_request(property_id)
+    return _http_get(url, params=querystring, headers=headers).json()
+
+@bhu_checkpoint(key=string.Template('${lat}_${lon}.pkl'), 
+            work_dir='BHU/Saved Results/WalkScore/', prod=prod,
+            ttl=CHECKPOINT_TTL['WalkScore'], max_bytes=CHECKPOINT_MAX_BYTES,
+            memory_bytes=CHECKPOINT_MEMORY_BYTES,
+            pickler=checkpoint_codec.pickler, unpickler=checkpoint_codec.unpickler)
+@retry(stop_max_attempt_number=5, retry_on_exception=_retry_unless_rate_limited)
+def get_WalkScore(
+    address : str,
+    lat : float,
+    lon : float,
+    prod : bool = prod
+    ) -> dict:
+
+    url, querystring, headers = _walk_score_request(address, lat, lon)
+    return _http_get(url, params=querystring, headers=headers).json()
+
+def _properties_request(
         market_status : Literal['for_sale','sold'],
         city_state    : Tuple[None, Tuple[str, str]] = None,
         zip_code      : Tuple[None, str] = None,
-        n_results     : int = 1000,
         property_type : str = 'single_family',
-        offset        : int = 0,
-        verbose       : bool = False
-    ) -> dict:
-    
+        offset        : int = 0
+    ) -> Tuple[str, dict]:
     '''
-    This function will return properties, either recently sold or currently on the market, 
-    within a specific city and state or zip code.
-    Required fields: market_status, EITHER city_state or zip_code.
-
-    There is something strange about the way this is setup where checkpointing fails, 
-    and am not sure why that is happening.
-    For now, I will be checkpointing the parent function.
-
-    Although offset might seem a bit strange to pass in here,I will be checking that there is enough samples 
-    requested. The first round of outputs will dictate if we need to query more sold/for sale homes.
+    The url and first page querystring for a property search, see get_Properties.
     '''
-
     if city_state is None and zip_code is None:
         raise Exception('Either city_state or zip_code is required.')
 
@@ -173,6 +248,34 @@ def get_Properties(
             "zipcode":zip_code,
         })
 
+    return url, querystring
+
+def get_Properties(
+        parent_pid    : str,
+        market_status : Literal['for_sale','sold'],
+        city_state    : Tuple[None, Tuple[str, str]] = None,
+        zip_code      : Tuple[None, str] = None,
+        n_results     : int = 1000,
+        property_type : str = 'single_family',
+        offset        : int = 0,
+        verbose       : bool = False
+    ) -> dict:
+    
+    '''
+    This function will return properties, either recently sold or currently on the market, 
+    within a specific city and state or zip code.
+    Required fields: market_status, EITHER city_state or zip_code.
+
+    There is something strange about the way this is setup where checkpointing fails, 
+    and am not sure why that is happening.
+    For now, I will be checkpointing the parent function.
+
+    Although offset might seem a bit strange to pass in here,I will be checking that there is enough samples 
+    requested. The first round of outputs will dictate if we need to query more sold/for sale homes.
+    '''
+
+    url, querystring = _properties_request(market_status, city_state, zip_code, property_type, offset)
+
     geo_to_return, houses_to_return = query_url(
         n_results, 
         verbose, 
@@ -181,16 +284,49 @@ def get_Properties(
         zzzparent_pid = parent_pid,
         zzzzipcode = querystring.get('zipcode', '00000'),
         zzzcity = querystring.get('city', 'XXXXX'),
-        zzzsort = querystring.get('sort')
+        zzzsort = querystring.get('sort'),
+        zzzoffset = querystring.get('offset')
     )
 
     return {
         'houses' : houses_to_return,
         'geo' : geo_to_return
     }
-@bhu_checkpoint(key=string.Template('${zzzparent_pid}_${zzzzipcode}_${zzzcity}_${zzzsort}.pkl'),
-            work_dir='BHU/Saved Results/Properties/', prod=prod)
-@retry(stop_max_attempt_number=5)
+
+def _page_results(response : dict, v2 : bool) -> List[dict]:
+    return response['data']['home_search']['results'] if v2 else response['data']['results']
+
+def _get_page_results(url : str, querystring : dict, v2 : bool) -> List[dict]:
+    return _page_results(_http_get(url, params=querystring, headers=USREALESTATE_API_HEADERS).json(), v2)
+
+def _first_page(response : dict, v2 : bool) -> Tuple[int, dict, List[dict]]:
+    '''
+    The total number of houses available, the geo and the houses from the first page of a property search.
+    '''
+    total_houses_available = response['data']['home_search']['total'] if v2 else response['data']['total']
+    geo = response['data']['geo'] if v2 else {}
+    return int(total_houses_available), geo, _page_results(response, v2)
+
+def _page_querystrings(querystring : dict, houses_remaining : int, next_offset : int) -> List[dict]:
+    '''
+    One querystring per page still needed to get houses_remaining more houses, starting at next_offset.
+    '''
+    pages = []
+    for i in range(-(-houses_remaining // RESULTS_PER_REQUEST_LIMIT)):
+        page_querystring = querystring.copy()
+        page_querystring['offset'] = str(next_offset + i * RESULTS_PER_REQUEST_LIMIT)
+        page_querystring['limit'] = str(
+            min(RESULTS_PER_REQUEST_LIMIT, houses_remaining - i * RESULTS_PER_REQUEST_LIMIT)
+        )
+        pages.append(page_querystring)
+    return pages
+
+@bhu_checkpoint(key=string.Template('${zzzparent_pid}_${zzzzipcode}_${zzzcity}_${zzzsort}_${zzzoffset}.pkl'),
+            work_dir='BHU/Saved Results/Properties/', prod=prod,
+            ttl=CHECKPOINT_TTL['Properties'], max_bytes=CHECKPOINT_MAX_BYTES,
+            memory_bytes=CHECKPOINT_MEMORY_BYTES,
+            pickler=checkpoint_codec.pickler, unpickler=checkpoint_codec.unpickler)
+@retry(stop_max_attempt_number=5, retry_on_exception=_retry_unless_rate_limited)
 def query_url(
         n_results : int, 
         verbose : bool, 
@@ -200,6 +336,7 @@ def query_url(
         zzzzipcode : str,
         zzzcity : str,
         zzzsort : str,
+        zzzoffset : str = '0',
         prod : bool = prod
     ) -> Tuple[dict, List[dict]]:
     '''
@@ -211,12 +348,8 @@ def query_url(
 
     v2 : bool = 'v2' in url
 
-    response = requests.request("GET", url, headers=USREALESTATE_API_HEADERS, params=querystring).json()
-    total_houses_available = response['data']['home_search']['total'] if v2 else response['data']['total']
-    total_houses_in_request = response['data']['home_search']['count'] if v2 else response['data']['count'] 
-
-    total_houses_available = int(total_houses_available)
-    total_houses_in_request = int(total_houses_in_request)
+    response = _http_get(url, params=querystring, headers=USREALESTATE_API_HEADERS).json()
+    total_houses_available, geo_to_return, houses_to_return = _first_page(response, v2)
 
     if n_results is None:
         n_results = total_houses_available
@@ -225,22 +358,26 @@ def query_url(
         print(f'Returning {str(min(total_houses_available, n_results))} \
                 out of a possible {str(total_houses_available)}.')
 
-    geo_to_return = response['data']['geo'] if v2 else {}
-    houses_to_return = response['data']['home_search']['results'] if v2 else response['data']['results']
-
     houses_remaining = min(total_houses_available, n_results) - len(houses_to_return)
 
+    # Now that we know how many there are, go get the rest of the pages at the same time, and put them back in
+    # order. If a page comes back short we go around again from where the last round left off.
+    next_offset = int(querystring['offset']) + RESULTS_PER_REQUEST_LIMIT
     while houses_remaining > 0:
-        querystring['offset'] = str(int(querystring['offset']) + RESULTS_PER_REQUEST_LIMIT)
-        querystring['limit'] = str(min(RESULTS_PER_REQUEST_LIMIT, houses_remaining))
+        pages = _page_querystrings(querystring, houses_remaining, next_offset)
+
+        with ThreadPoolExecutor(max_workers=min(PAGE_CONCURRENCY, len(pages))) as pool:
+            page_results = list(pool.map(lambda qs: _get_page_results(url, qs, v2), pages))
+
+        n_returned = sum(len(r) for r in page_results)
+        for r in page_results:
+            houses_to_return.extend(r)
+        houses_remaining -= n_returned
+        next_offset += len(pages) * RESULTS_PER_REQUEST_LIMIT
 
-        response = requests.request("GET", url, headers=USREALESTATE_API_HEADERS, params=querystring).json()
-        if v2:
-            houses_to_return.extend(response['data']['home_search']['results'])
-            houses_remaining -= len(response['data']['home_search']['results'])
-        else:
-            houses_to_return.extend(response['data']['results'])
-            houses_remaining -= len(response['data']['results'])
+        if n_returned == 0:
+            # Nothing left upstream, even if total said otherwise.
+            break
 
     return geo_to_return, houses_to_return
 
@@ -311,48 +448,46 @@ def get_HousesOfInterest(
         raise Exception('User house does not have a valid property id.')
     
     # I am just going to go with city (for now)
-    listed_homes = get_Properties(
-        parent_pid=parent_pid,
-        market_status='for_sale',
-        city_state=(address.get('city'), address.get('state_code')),
-        n_results=n_listed
-    )
-
-    sold_homes = get_Properties(
-        parent_pid=parent_pid,
-        market_status='sold',
-        city_state=(address.get('city'), address.get('state_code')),
-        n_results=n_sold
-    )
-
-    if len(listed_homes['houses']) < n_listed:
-        new_n_results = n_listed-len(listed_homes['houses']) 
-        if verbose:
-            print(f'Shortfall in listed houses detected, appending {str(new_n_results)} of current listing to results.')
+    city_state = (address.get('city'), address.get('state_code'))
 
-        sold_homes_v2 = get_Properties(
+    # Listed and sold do not depend on each other, so they go out at the same time. A shortfall in one is topped up
+    # from the other, and that top up goes out as soon as the query that came up short is back, without waiting on
+    # the other one.
+    def get_with_top_up(market_status, n_results, top_up_status, top_up_n_results):
+        homes = get_Properties(
             parent_pid=parent_pid,
-            market_status='sold',
-            city_state=(address.get('city'), address.get('state_code')),
-            n_results=n_listed - len(listed_homes['houses']),
-            offset=new_n_results
+            market_status=market_status,
+            city_state=city_state,
+            n_results=n_results
         )
 
+        top_up = None
+        if len(homes['houses']) < n_results:
+            new_n_results = n_results - len(homes['houses'])
+            if verbose:
+                print(f'Shortfall in {market_status} houses detected, '
+                      f'appending {str(new_n_results)} of {top_up_status} to results.')
+
+            top_up = get_Properties(
+                parent_pid=parent_pid,
+                market_status=top_up_status,
+                city_state=city_state,
+                n_results=top_up_n_results(new_n_results),
+                offset=new_n_results
+            )
+        return homes, top_up
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        listed_future = pool.submit(get_with_top_up, 'for_sale', n_listed, 'sold', lambda shortfall: shortfall)
+        sold_future = pool.submit(get_with_top_up, 'sold', n_sold, 'for_sale', lambda shortfall: n_listed)
+
+        listed_homes, sold_homes_v2 = listed_future.result()
+        sold_homes, listed_homes_v2 = sold_future.result()
+
+    if sold_homes_v2 is not None:
         sold_homes['houses'].extend(sold_homes_v2['houses'])
 
-    if len(sold_homes['houses']) < n_sold:
-        new_n_results = n_sold-len(sold_homes['houses'])
-        if verbose:
-            print(f'Shortfall in listed houses detected, appending {str(new_n_results)} of current listing to results.')
-
-        listed_homes_v2 = get_Properties(
-            parent_pid=parent_pid,
-            market_status='for_sale',
-            city_state=(address.get('city'), address.get('state_code')),
-            n_results=n_listed,
-            offset=new_n_results
-        )
-        
+    if listed_homes_v2 is not None:
         listed_homes['houses'].extend(listed_homes_v2['houses'])
 
     # Geo will be the same for both unless one returns a zip_code not in the other, but if that happens 
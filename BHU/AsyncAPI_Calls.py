@@ -0,0 +1,151 @@
+#type:ignore
+import asyncio
+import contextlib
+from typing import Literal, Tuple, List
+
+import aiohttp
+
+from BHU.API_Calls import (
+    REQUEST_TIMEOUT, HTTP_POOL_SIZE, RESULTS_PER_REQUEST_LIMIT, USREALESTATE_API_HEADERS,
+    _location_suggest_request, _property_detail_request, _property_value_request, _walk_score_request,
+    _properties_request, _first_page, _page_results, _page_querystrings
+)
+from BHU.RateLimit import rate_limiter
+
+'''
+Coroutine versions of the API_Calls functions, for batch jobs that want hundreds of requests in flight without a
+thread for each. They build the exact same requests as the blocking functions and take from the same token
+buckets (BHU.RateLimit), so running them next to the app does not push us over quota.
+
+    async with api_session() as session:
+        details = await asyncio.gather(*[get_PropertyDetail(pid, session=session) for pid in property_ids])
+
+These do not read or write the bhu_checkpoint cache under BHU/Saved Results, they always go to the API.
+'''
+
+RETRY_ATTEMPTS = 5
+
+def api_session() -> aiohttp.ClientSession:
+    '''
+    A session with the same timeouts and connection limit per host as the blocking calls.
+    '''
+    connect_timeout, read_timeout = REQUEST_TIMEOUT
+    return aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+        connector=aiohttp.TCPConnector(limit_per_host=HTTP_POOL_SIZE)
+    )
+
+@contextlib.asynccontextmanager
+async def _session_or_new(session : aiohttp.ClientSession = None):
+    if session is not None:
+        yield session
+        return
+    async with api_session() as session:
+        yield session
+
+async def _get_json(session : aiohttp.ClientSession, url : str, params : dict = None, headers : dict = None) -> dict:
+    '''
+    Same deal as @retry(stop_max_attempt_number=5) on the blocking side, every attempt takes its own token.
+    '''
+    params = {k : str(v) for k, v in (params or {}).items()}
+    for attempt in range(RETRY_ATTEMPTS):
+        await rate_limiter(url).acquire_async()
+        try:
+            async with session.get(url, params=params, headers=headers) as response:
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise
+
+async def get_LocationSuggest(
+        search_keyword : str,
+        return_all     : bool = False,
+        session        : aiohttp.ClientSession = None
+    ) -> dict:
+
+    url, querystring, headers = _location_suggest_request(search_keyword)
+    async with _session_or_new(session) as session:
+        response_json = await _get_json(session, url, querystring, headers)
+    return response_json if return_all else response_json['data'][0]
+
+async def get_PropertyDetail(
+        property_id : str,
+        session     : aiohttp.ClientSession = None
+    ) -> dict:
+
+    url, querystring, headers = _property_detail_request(property_id)
+    async with _session_or_new(session) as session:
+        return await _get_json(session, url, querystring, headers)
+
+async def get_PropertyValue(
+        property_id : str,
+        session     : aiohttp.ClientSession = None
+    ) -> dict:
+
+    url, querystring, headers = _property_value_request(property_id)
+    async with _session_or_new(session) as session:
+        return await _get_json(session, url, querystring, headers)
+
+async def get_WalkScore(
+        address : str,
+        lat     : float,
+        lon     : float,
+        session : aiohttp.ClientSession = None
+    ) -> dict:
+
+    url, querystring, headers = _walk_score_request(address, lat, lon)
+    async with _session_or_new(session) as session:
+        return await _get_json(session, url, querystring, headers)
+
+async def get_Properties(
+        parent_pid    : str,
+        market_status : Literal['for_sale','sold'],
+        city_state    : Tuple[None, Tuple[str, str]] = None,
+        zip_code      : Tuple[None, str] = None,
+        n_results     : int = 1000,
+        property_type : str = 'single_family',
+        offset        : int = 0,
+        verbose       : bool = False,
+        session       : aiohttp.ClientSession = None
+    ) -> dict:
+    '''
+    Same arguments and return as API_Calls.get_Properties (parent_pid is only the cache key over there, so it is
+    not used here). The first page tells us the total, then every other page is requested at once and the
+    rate limiter decides how fast they actually go out.
+    '''
+    url, querystring = _properties_request(market_status, city_state, zip_code, property_type, offset)
+    v2 : bool = 'v2' in url
+
+    async with _session_or_new(session) as session:
+        response = await _get_json(session, url, querystring, USREALESTATE_API_HEADERS)
+        total_houses_available, geo_to_return, houses_to_return = _first_page(response, v2)
+
+        if n_results is None:
+            n_results = total_houses_available
+
+        if verbose:
+            print(f'Returning {str(min(total_houses_available, n_results))} \
+                    out of a possible {str(total_houses_available)}.')
+
+        houses_remaining = min(total_houses_available, n_results) - len(houses_to_return)
+        next_offset = int(querystring['offset']) + RESULTS_PER_REQUEST_LIMIT
+        while houses_remaining > 0:
+            pages = _page_querystrings(querystring, houses_remaining, next_offset)
+            responses = await asyncio.gather(
+                *[_get_json(session, url, qs, USREALESTATE_API_HEADERS) for qs in pages]
+            )
+            page_results = [_page_results(r, v2) for r in responses]
+
+            n_returned = sum(len(r) for r in page_results)
+            for r in page_results:
+                houses_to_return.extend(r)
+            houses_remaining -= n_returned
+            next_offset += len(pages) * RESULTS_PER_REQUEST_LIMIT
+
+            if n_returned == 0:
+                break
+
+    return {
+        'houses' : houses_to_return,
+        'geo' : geo_to_return
+    }
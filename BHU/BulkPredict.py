@@ -0,0 +1,82 @@
+import os
+import json
+import math
+from typing import Iterable, Iterator, List, Tuple
+
+from BHU.KerasTransformers import predict_rows
+from BHU.ModelRegistry import model_registry
+
+BULK_CHUNK_SIZE = int(os.environ.get('BHU_BULK_CHUNK_SIZE', 512))
+
+def _model_name(row : dict) -> str:
+    '''
+    Either the row says which model it wants, or we build it the same way the app does from city and state.
+    '''
+    if row.get('model_name'):
+        return str(row['model_name']).upper()
+    city = row.get('city') or ''
+    state = row.get('state_code') or row.get('state') or ''
+    if not city or not state:
+        raise ValueError('Each row needs a model_name, or a city and state_code.')
+    return f'{city.upper()}_{state.upper()}'
+
+def _result(index : int, **kwargs) -> str:
+    # NaN / Infinity are not JSON, one of them would break the whole stream for a strict reader.
+    return json.dumps({'index' : index, **kwargs}, allow_nan=False) + '\n'
+
+def _score_chunk(model_name : str, chunk : List[Tuple[int, dict]], registry) -> Iterator[str]:
+    try:
+        predictions = predict_rows(registry.get(model_name), [row for _, row in chunk])
+    except Exception as e:
+        for index, _ in chunk:
+            yield _result(index, model_name=model_name, error=str(e))
+        return
+
+    for (index, _), p in zip(chunk, predictions):
+        p = float(p)
+        if not math.isfinite(p):
+            # Usually a row missing numeric features the model needs.
+            yield _result(index, model_name=model_name, error='non-finite prediction')
+            continue
+        yield _result(index, model_name=model_name, prediction=p)
+
+def stream_batch_predictions(lines : Iterable,
+                             registry = model_registry,
+                             chunk_size : int = BULK_CHUNK_SIZE) -> Iterator[str]:
+    '''
+    Takes JSON Lines (one feature dict per line, str or bytes) and yields JSON Lines back, one per input line:
+        {"index" : line number (from 0), "model_name" : ..., "prediction" : ...}
+    or, if that line could not be scored,
+        {"index" : line number, "error" : ...}
+
+    Rows are grouped by model and scored chunk_size at a time, as soon as a model's chunk fills up, so results come
+    back out of order (that is what index is for) and we never hold more than a chunk per model in memory.
+    '''
+    pending = {}
+    for index, line in enumerate(lines):
+        try:
+            # A line that is not utf-8 is a bad line like any other (UnicodeDecodeError is a ValueError).
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError('Each line must be a JSON object.')
+            model_name = _model_name(row)
+        except ValueError as e:
+            yield _result(index, error=str(e))
+            continue
+
+        if not registry.is_available(model_name):
+            yield _result(index, model_name=model_name, error=f'No model available for {model_name}.')
+            continue
+
+        chunk = pending.setdefault(model_name, [])
+        chunk.append((index, row))
+        if len(chunk) >= chunk_size:
+            yield from _score_chunk(model_name, pending.pop(model_name), registry)
+
+    for model_name, chunk in pending.items():
+        yield from _score_chunk(model_name, chunk, registry)
@@ -3,16 +3,553 @@
 # I actually got some help with ChatGPT on this one, lmao.
 
 import os
+import io
 import pickle
+import time
+import sqlite3
+import functools
+import threading
 import logging
 from string import Template
 from tempfile import gettempdir
 import types
+import zlib
+import struct
+import hashlib
+import contextlib
+from collections import OrderedDict
+
+from BHU.SingleFlight import file_lock
 
 __author__ = 'pavan.mnssk@gmail.com'
 # ^^^ original author, I only added the trivial flag.
 
-def bhu_checkpoint(key=0, unpickler=pickle.load, pickler=pickle.dump, work_dir=gettempdir(), refresh=False, prod=False):
+'''
+Where the checkpoints actually live is a backend. FileBackend is the original layout, one pickle per key in
+work_dir. SQLiteBackend keeps a whole work_dir (PropertyDetail, WalkScore, Properties...) in one indexed file,
+work_dir/checkpoint.sqlite, so there are no directory scans or tens of thousands of tiny files.
+BHU_CHECKPOINT_BACKEND=sqlite switches every decorator that does not ask for a backend itself.
+
+Each work_dir is a namespace (CheckpointNamespace) with an optional ttl and a max_bytes / max_entries budget that
+is kept by evicting whatever was read least recently. memory_entries / memory_bytes put a MemoryTier in front of
+the backend for that one function.
+
+Shared mode (BHU_CHECKPOINT_SHARED, on by default in prod, ie when LIVE is set) is what lets every gunicorn worker
+use the same cache. A miss takes a file lock for its key (only that key, so a slow fetch holds up nobody else) and
+looks again before calling the function, so only one worker fetches it,
+and every entry carries a checksum so a torn or corrupt entry is thrown away and refetched instead of served.
+With shared mode off, prod=True skips the cache completely.
+
+python -m BHU.Checkpoint import "BHU/Saved Results/PropertyDetail/" copies an existing pickle directory into SQLite.
+python -m BHU.Checkpoint report | compact shows usage of / evicts and compacts every namespace API_Calls uses.
+'''
+
+CHECKPOINT_BACKEND = os.environ.get('BHU_CHECKPOINT_BACKEND', 'file')
+# Longest a checkpoint is served out of the in process memory tier before we look at the backend again.
+CHECKPOINT_MEMORY_TTL = float(os.environ.get('BHU_CHECKPOINT_MEMORY_TTL', 15 * 60))
+CHECKPOINT_SHARED = os.environ.get('BHU_CHECKPOINT_SHARED', '1' if 'LIVE' in os.environ else '0') != '0'
+
+# magic, format version, crc32 of the payload, payload length
+CHECKPOINT_HEADER = struct.Struct('!4sBIQ')
+CHECKPOINT_MAGIC = b'BHUC'
+CHECKPOINT_FORMAT = 1
+
+class CorruptCheckpoint(Exception):
+    pass
+
+class UnreadableCheckpoint(Exception):
+    '''
+    For unpicklers to raise when the entry is fine but this process can not read it (ie it was written with a
+    codec whose package is not installed here). It is a miss, and the entry is kept rather than recomputed over.
+    '''
+    pass
+
+def seal(payload : bytes) -> bytes:
+    return CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_FORMAT, zlib.crc32(payload), len(payload)) + payload
+
+def unseal(data : bytes) -> bytes:
+    '''
+    The payload back out of seal, checked. Anything without the header was written before there was one and is
+    passed through as is.
+    '''
+    if not data.startswith(CHECKPOINT_MAGIC):
+        return data
+    if len(data) < CHECKPOINT_HEADER.size:
+        raise CorruptCheckpoint('Checkpoint is shorter than its header.')
+    _, version, crc, length = CHECKPOINT_HEADER.unpack_from(data)
+    payload = data[CHECKPOINT_HEADER.size:]
+    if version != CHECKPOINT_FORMAT:
+        raise CorruptCheckpoint(f'Checkpoint format {version}, expected {CHECKPOINT_FORMAT}.')
+    if len(payload) != length or zlib.crc32(payload) != crc:
+        raise CorruptCheckpoint(f'Checkpoint checksum mismatch ({len(payload)} of {length} bytes).')
+    return payload
+
+class FileBackend():
+    '''
+    One file per key. Writes go to a temp file first and get renamed over, so a reader never sees half a pickle.
+    The file's mtime is when it was written and its atime is bumped on every read, which is what TTLs and LRU go by.
+    '''
+    def __init__(self, work_dir : str):
+        self.work_dir = work_dir
+
+    def __repr__(self) -> str:
+        return f'File checkpoints in {self.work_dir}.'
+
+    def path(self, key : str) -> str:
+        return os.path.join(self.work_dir, key)
+
+    def get(self, key : str, ttl : float = None) -> bytes:
+        path = self.path(key)
+        try:
+            written = os.stat(path).st_mtime
+            if ttl is not None and written < time.time() - ttl:
+                return None
+            with open(path, 'rb') as f:
+                value = f.read()
+            # Set explicitly, relatime / noatime mounts do not keep atime up to date for us. Only the owner may, a
+            # worker running as someone else just does not bump it.
+            try:
+                os.utime(path, (time.time(), written))
+            except OSError:
+                pass
+            return value
+        except FileNotFoundError:
+            return None
+
+    def put(self, key : str, value : bytes) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(value)
+        os.replace(temp_path, path)
+
+    def delete(self, key : str) -> None:
+        self.delete_many([key])
+
+    def delete_many(self, keys) -> None:
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def _files(self) -> list:
+        if not os.path.isdir(self.work_dir):
+            return []
+        return [e for e in os.scandir(self.work_dir) if e.is_file() and not e.name.endswith('.tmp')]
+
+    def keys(self) -> list:
+        return sorted(e.name for e in self._files())
+
+    def entries(self) -> list:
+        '''
+        (key, size, written, last read) for everything stored.
+        '''
+        entries = []
+        for e in self._files():
+            try:
+                stat = e.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((e.name, stat.st_size, stat.st_mtime, max(stat.st_atime, stat.st_mtime)))
+        return entries
+
+    def usage(self) -> tuple:
+        entries = self.entries()
+        return len(entries), sum(e[1] for e in entries)
+
+    def compact(self) -> None:
+        # Temp files from writers that died mid write.
+        if not os.path.isdir(self.work_dir):
+            return
+        stale = time.time() - 60 * 60
+        for e in os.scandir(self.work_dir):
+            if e.is_file() and e.name.endswith('.tmp') and e.stat().st_mtime < stale:
+                os.remove(e.path)
+
+class SQLiteBackend():
+    '''
+    One SQLite file per namespace, key -> pickled bytes. Each thread gets its own connection, WAL lets readers and
+    the writer (in any process) go at the same time, and every put is its own transaction.
+    Last read times are only written when they are more than ACCESS_RESOLUTION seconds stale, so a hot key is not
+    a write on every read.
+    '''
+    FILE_NAME = 'checkpoint.sqlite'
+    ACCESS_RESOLUTION = 60
+
+    def __init__(self, work_dir : str):
+        self.work_dir = work_dir
+        self.db_path = os.path.join(work_dir, self.FILE_NAME)
+        self._local = threading.local()
+
+    def __repr__(self) -> str:
+        return f'SQLite checkpoints in {self.db_path}.'
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(self.work_dir, exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoints ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, created REAL NOT NULL, size INTEGER NOT NULL, '
+                'accessed REAL)'
+            )
+            columns = [r[1] for r in connection.execute('PRAGMA table_info(checkpoints)')]
+            if 'accessed' not in columns:
+                # Made before eviction was a thing.
+                connection.execute('ALTER TABLE checkpoints ADD COLUMN accessed REAL')
+                connection.execute('UPDATE checkpoints SET accessed = created')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key : str, ttl : float = None) -> bytes:
+        connection = self._connection()
+        row = connection.execute('SELECT value, created, accessed FROM checkpoints WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if ttl is not None and row[1] < now - ttl:
+            return None
+        if (row[2] or 0) < now - self.ACCESS_RESOLUTION:
+            connection.execute('UPDATE checkpoints SET accessed = ? WHERE key = ?', (now, key))
+        return bytes(row[0])
+
+    def put(self, key : str, value : bytes) -> None:
+        self.put_many([(key, value)])
+
+    def put_many(self, items) -> int:
+        connection = self._connection()
+        n = 0
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            for key, value in items:
+                now = time.time()
+                connection.execute(
+                    'INSERT OR REPLACE INTO checkpoints (key, value, created, size, accessed) VALUES (?, ?, ?, ?, ?)',
+                    (key, sqlite3.Binary(value), now, len(value), now)
+                )
+                n += 1
+        return n
+
+    def delete(self, key : str) -> None:
+        self.delete_many([key])
+
+    def delete_many(self, keys) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('DELETE FROM checkpoints WHERE key = ?', [(k,) for k in keys])
+
+    def keys(self) -> list:
+        return [r[0] for r in self._connection().execute('SELECT key FROM checkpoints ORDER BY key')]
+
+    def entries(self) -> list:
+        return [tuple(r) for r in self._connection().execute(
+            'SELECT key, size, created, COALESCE(accessed, created) FROM checkpoints'
+        )]
+
+    def usage(self) -> tuple:
+        return tuple(self._connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM checkpoints').fetchone())
+
+    def compact(self) -> None:
+        connection = self._connection()
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        connection.execute('VACUUM')
+
+BACKENDS = {
+    'file' : FileBackend,
+    'sqlite' : SQLiteBackend
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend(backend, work_dir : str):
+    '''
+    backend is a name out of BACKENDS, a backend class, or an instance (used as is). Decorators on the same work_dir
+    share one instance.
+    '''
+    if backend is None:
+        backend = CHECKPOINT_BACKEND
+    if not isinstance(backend, (str, type)):
+        return backend
+    backend_class = BACKENDS[backend] if isinstance(backend, str) else backend
+    with _backends_lock:
+        key = (backend_class, os.path.normpath(work_dir))
+        if key not in _backends:
+            _backends[key] = backend_class(work_dir)
+        return _backends[key]
+
+def import_pickle_directory(work_dir : str, backend = 'sqlite') -> int:
+    '''
+    Copies every checkpoint file in work_dir into backend (keys stay the file names), returns how many.
+    The files are left where they are.
+    '''
+    source = FileBackend(work_dir)
+    target = get_backend(backend, work_dir)
+    keys = [k for k in source.keys() if k != SQLiteBackend.FILE_NAME and not k.startswith(SQLiteBackend.FILE_NAME)]
+    items = ((k, source.get(k)) for k in keys)
+    if hasattr(target, 'put_many'):
+        return target.put_many(items)
+    for k, v in items:
+        target.put(k, v)
+    return len(keys)
+
+class CheckpointNamespace():
+    '''
+    Everything cached under one work_dir (PropertyDetail, WalkScore, Properties...) and the rules for it:
+        ttl - seconds an entry is good for, after that it is a miss and gets refetched.
+        max_bytes / max_entries - budget for the namespace. Once a put takes it over, the least recently read
+            entries are dropped until it is back under EVICT_TO of the budget, so we are not evicting on every put.
+    Usage between evictions is counted in memory, so with several processes writing it is approximate, but every
+    eviction starts from what is actually stored.
+    '''
+    EVICT_TO = 0.9
+
+    def __init__(self,
+                 work_dir : str,
+                 backend = None,
+                 ttl : float = None,
+                 max_bytes : int = None,
+                 max_entries : int = None):
+        self.name = os.path.basename(os.path.normpath(work_dir))
+        self.work_dir = work_dir
+        self.backend = backend
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+        self._store = None
+        self._usage : list = None
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f'Checkpoint namespace {self.name}.'
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = get_backend(self.backend, self.work_dir)
+        return self._store
+
+    def _over_budget(self, n_entries : int, n_bytes : int, fraction : float = 1.0) -> bool:
+        return (self.max_entries is not None and n_entries > self.max_entries * fraction) or \
+            (self.max_bytes is not None and n_bytes > self.max_bytes * fraction)
+
+    def get(self, key : str) -> bytes:
+        data = self.store.get(key, ttl=self.ttl)
+        if data is None:
+            return None
+        try:
+            return unseal(data)
+        except CorruptCheckpoint as e:
+            logging.warning('bhu_checkpoint %s dropping %s: %s', self.name, key, e)
+            self.store.delete(key)
+            return None
+
+    def put(self, key : str, value : bytes) -> None:
+        value = seal(value)
+        self.store.put(key, value)
+        if self.max_bytes is None and self.max_entries is None:
+            return
+
+        with self._lock:
+            if self._usage is None:
+                self._usage = list(self.store.usage())
+            else:
+                self._usage[0] += 1
+                self._usage[1] += len(value)
+            over = self._over_budget(*self._usage)
+        if over:
+            self.evict()
+
+    def _lock_path(self, key : str) -> str:
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(self.work_dir, '.locks', f'{digest}.lock')
+
+    def key_lock(self, key : str):
+        '''
+        Exclusive lock (across threads and processes) on exactly this key. It is held for the whole fetch, so
+        it must not be shared with other keys.
+        '''
+        return file_lock(self._lock_path(key))
+
+    def remove_idle_locks(self) -> int:
+        '''
+        Lock files are left behind, one per key ever fetched. This drops the ones whose key is not stored anymore
+        and that nobody holds right now.
+        '''
+        lock_dir = os.path.join(self.work_dir, '.locks')
+        if not os.path.isdir(lock_dir):
+            return 0
+        stored = {os.path.basename(self._lock_path(k)) for k in self.store.keys()}
+        removed = 0
+        for e in os.scandir(lock_dir):
+            if not e.name.endswith('.lock') or e.name in stored:
+                continue
+            with file_lock(e.path, blocking=False) as locked:
+                if locked:
+                    os.remove(e.path)
+                    removed += 1
+        return removed
+
+    def evict(self, fraction : float = None) -> dict:
+        '''
+        Drops expired entries, then least recently read ones until we are within fraction of the budget.
+        '''
+        fraction = self.EVICT_TO if fraction is None else fraction
+        entries = self.store.entries()
+
+        now = time.time()
+        expired = [e for e in entries if self.ttl is not None and e[2] < now - self.ttl]
+        expired_keys = {e[0] for e in expired}
+        remaining = sorted((e for e in entries if e[0] not in expired_keys), key=lambda e: e[3])
+
+        n_entries, n_bytes = len(remaining), sum(e[1] for e in remaining)
+        lru = []
+        while remaining and self._over_budget(n_entries, n_bytes, fraction):
+            e = remaining.pop(0)
+            lru.append(e)
+            n_entries -= 1
+            n_bytes -= e[1]
+
+        if expired or lru:
+            self.store.delete_many([e[0] for e in expired + lru])
+            logging.info('bhu_checkpoint %s evicted %d expired and %d least recently used.',
+                         self.name, len(expired), len(lru))
+        with self._lock:
+            self._usage = [n_entries, n_bytes]
+        return {'expired' : len(expired), 'evicted' : len(lru), 'freed_bytes' : sum(e[1] for e in expired + lru)}
+
+    def report(self) -> dict:
+        entries = self.store.entries()
+        now = time.time()
+        return {
+            'namespace' : self.name,
+            'backend' : type(self.store).__name__,
+            'work_dir' : self.work_dir,
+            'entries' : len(entries),
+            'bytes' : sum(e[1] for e in entries),
+            'expired' : sum(1 for e in entries if self.ttl is not None and e[2] < now - self.ttl),
+            'oldest_days' : round((now - min(e[2] for e in entries)) / 86400, 1) if entries else None,
+            'ttl' : self.ttl,
+            'max_bytes' : self.max_bytes,
+            'max_entries' : self.max_entries
+        }
+
+    def compact(self) -> dict:
+        evicted = self.evict(fraction=1.0)
+        self.store.compact()
+        return {**evicted, 'locks_removed' : self.remove_idle_locks()}
+
+checkpoint_namespaces = {}
+
+def register_namespace(work_dir : str, backend = None, ttl : float = None, max_bytes : int = None,
+                       max_entries : int = None) -> CheckpointNamespace:
+    '''
+    Every decorated function registers its work_dir here, which is what the maintenance commands walk. Functions
+    sharing a work_dir share a namespace, and the first one to register sets its rules.
+    '''
+    namespace = CheckpointNamespace(work_dir, backend, ttl, max_bytes, max_entries)
+    return checkpoint_namespaces.setdefault(os.path.normpath(work_dir), namespace)
+
+class MemoryTier():
+    '''
+    A small LRU of serialized checkpoints kept in process, in front of the backend, so looking the same property up
+    three times in one user flow only reads the disk once. It holds the pickled bytes rather than the objects,
+    so every caller still gets their own copy to mutate, same as coming off disk.
+    Entries live at most ttl seconds here, whatever the namespace ttl says.
+    '''
+    def __init__(self,
+                 name : str,
+                 max_entries : int = None,
+                 max_bytes : int = None,
+                 ttl : float = CHECKPOINT_MEMORY_TTL):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counts = {'hits' : 0, 'misses' : 0, 'evictions' : 0}
+
+    def __repr__(self) -> str:
+        return f'Checkpoint memory tier for {self.name}.'
+
+    def get(self, key : str, count : bool = True) -> bytes:
+        '''
+        count=False for looking again at something that was just counted, so it does not show up twice in stats.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.monotonic() - self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._counts['misses'] += count
+                return None
+            self._entries.move_to_end(key)
+            self._counts['hits'] += count
+            return entry[0]
+
+    def put(self, key : str, value : bytes) -> None:
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic())
+            self._bytes += len(value)
+            while (self.max_entries is not None and len(self._entries) > self.max_entries) or \
+                    (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self._counts['evictions'] += 1
+
+    def discard(self, key : str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key : str) -> None:
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._counts['hits'] + self._counts['misses']
+            return {
+                'function' : self.name,
+                'entries' : len(self._entries),
+                'bytes' : self._bytes,
+                **self._counts,
+                'hit_rate' : round(self._counts['hits'] / lookups, 4) if lookups else None
+            }
+
+memory_tiers = {}
+
+def memory_tier_report() -> list:
+    '''
+    Counters for every memory tier in this process.
+    '''
+    return [tier.stats() for tier in memory_tiers.values()]
+
+# What load() gives back for an UnreadableCheckpoint, so the wrapper knows not to save over it.
+_KEEP_STORED = object()
+
+def bhu_checkpoint(key=0, unpickler=pickle.load, pickler=pickle.dump, work_dir=gettempdir(), refresh=False, prod=False,
+                   backend=None, ttl=None, max_bytes=None, max_entries=None, memory_entries=None, memory_bytes=None,
+                   shared=None):
     """
     A utility decorator to save intermediate results of a function. It is the
     caller's responsibility to specify a key naming scheme such that the output of
@@ -72,55 +609,158 @@ def bhu_checkpoint(key=0, unpickler=pickle.load, pickler=pickle.dump, work_dir=g
         your code.
     This way, you have control on what to refresh without modifying the code,
     by setting the defs either via input or by modifying defs.py.
+    :param backend: Where the checkpoints are kept, 'file' or 'sqlite' (see BACKENDS), a backend class or an
+    instance. Defaults to BHU_CHECKPOINT_BACKEND. The pickler and unpickler still see a file object either way.
+    :param ttl: Seconds a checkpoint is good for, older ones are recomputed. None keeps them forever.
+    :param max_bytes: / max_entries: Budget for everything in work_dir, see CheckpointNamespace.
+    :param memory_entries: / memory_bytes: If either is set, this function gets its own MemoryTier of that size.
+    :param prod: Default for the prod keyword the decorated function takes. In prod the cache is only used in
+    shared mode.
+    :param shared: Lock each key across processes while it is being computed. Defaults to BHU_CHECKPOINT_SHARED.
+    The decorated function also gets a .cached(*args, **kwargs), which returns (found, value) for what that call
+    would load, without ever calling the function.
     """
 
     def decorator(func):
-        def wrapped(*args, prod=False, **kwargs):
-            if prod:
+        namespace = register_namespace(work_dir, backend, ttl, max_bytes, max_entries)
+        memory = None
+        if memory_entries is not None or memory_bytes is not None:
+            memory_ttl = CHECKPOINT_MEMORY_TTL if namespace.ttl is None else min(CHECKPOINT_MEMORY_TTL, namespace.ttl)
+            memory = MemoryTier(f'{func.__module__}.{func.__qualname__}', memory_entries, memory_bytes, memory_ttl)
+            memory_tiers[memory.name] = memory
+
+        default_prod = prod
+        use_shared = CHECKPOINT_SHARED if shared is None else shared
+
+        def load(save_key, count=True):
+            # (found, value). Anything wrong with the cache is a miss, never an error for the caller. The entry is
+            # left alone: a failed read (permissions, a flaky mount...) says nothing about what is stored, and the
+            # namespace already drops entries whose checksum does not match. Recomputing writes over it anyway.
+            try:
+                saved = memory.get(save_key, count) if memory is not None else None
+                if saved is None:
+                    saved = namespace.get(save_key)
+                    if saved is None:
+                        return False, None
+                    if memory is not None:
+                        memory.put(save_key, saved)
+                logging.info("Checkpoint exists. Loading from: %s" % save_key)
+                return True, unpickler(io.BytesIO(saved))
+            except UnreadableCheckpoint as e:
+                logging.warning('bhu_checkpoint %s can not read %s, keeping it: %s', namespace.name, save_key, e)
+                return False, _KEEP_STORED
+            except Exception:
+                logging.exception('bhu_checkpoint %s could not load %s.', namespace.name, save_key)
+                if memory is not None:
+                    memory.discard(save_key)
+                return False, None
+
+        def save(save_key, out):
+            try:
+                buffer = io.BytesIO()
+                pickler(out, buffer)
+                namespace.put(save_key, buffer.getvalue())
+                if memory is not None:
+                    memory.put(save_key, buffer.getvalue())
+            except Exception:
+                logging.exception('bhu_checkpoint %s could not save %s.', namespace.name, save_key)
+
+        def make_key(args, kwargs):
+            # If first arg is a string, use it directly.
+            if isinstance(key, str):
+                return key
+            elif isinstance(key, Template):
+                save_key = key.substitute(kwargs)
+                return save_key.format(*args)
+            elif isinstance(key, types.FunctionType):
+                return key(args, kwargs)
+            else:
+                logging.warn('Using 0-th argument as default.')
+                save_key = '{0}'
+                return save_key.format(args[key])
+
+        @functools.wraps(func)
+        def wrapped(*args, prod=None, **kwargs):
+            prod = default_prod if prod is None else prod
+            if prod and not use_shared:
                 logging.info('bhu_checkpoint prod, no file looked for or generated.')
                 return func(*args, **kwargs)
             
             try:
-                # If first arg is a string, use it directly.
-                if isinstance(key, str):
-                    save_file = os.path.join(work_dir, key)
-                elif isinstance(key, Template):
-                    save_file = os.path.join(work_dir, key.substitute(kwargs))
-                    save_file = save_file.format(*args)
-                elif isinstance(key, types.FunctionType):
-                    save_file = os.path.join(work_dir, key(args, kwargs))
-                else:
-                    logging.warn('Using 0-th argument as default.')
-                    save_file = os.path.join(work_dir, '{0}')
-                    save_file = save_file.format(args[key])
-
-                logging.info('checkpoint@ %s' % save_file)
-
-                # cache_file doesn't exist, run the function and save output in checkpoint.
+                save_key = make_key(args, kwargs)
 
                 if isinstance(refresh, types.FunctionType):
                     do_refresh = refresh()
                 else:
                     do_refresh = refresh
-
-                if do_refresh or not os.path.exists(path=save_file):  # Otherwise compute it save it and return it.
-                    # If the program fails, don't checkpoint.
-                    try:
-                        out = func(*args, **kwargs)
-                    except: # a blank raise re-raises the last exception.
-                        raise
-                    else:  # If the program is successful, then go ahead and call the save function.
-                        with open(save_file, 'wb') as f:
-                            pickler(out, f)
-                            return out
-                # Otherwise, load the checkpoint file and send it.
-                else:
-                    logging.info("Checkpoint exists. Loading from: %s" % save_file)
-                    with open(save_file, 'rb') as f:
-                        return unpickler(f)
-            except:
+            except Exception:
+                logging.exception('bhu_checkpoint %s could not build a key, calling uncached.', namespace.name)
                 return func(*args, **kwargs)
-            
+
+            logging.info('checkpoint@ %s %s' % (namespace.name, save_key))
+
+            keep_stored = False
+            if not do_refresh:
+                found, out = load(save_key)
+                if found:
+                    return out
+                keep_stored = out is _KEEP_STORED
+
+            lock = namespace.key_lock(save_key) if use_shared else contextlib.nullcontext()
+            with lock:
+                if use_shared and not do_refresh:
+                    # Another worker may have filled it while we waited for the lock. Same lookup as the one
+                    # above as far as the stats go.
+                    found, out = load(save_key, count=False)
+                    if found:
+                        return out
+                    keep_stored = out is _KEEP_STORED
+                # If the program fails, don't checkpoint, the exception goes straight to the caller.
+                out = func(*args, **kwargs)
+                if not keep_stored:
+                    save(save_key, out)
+            return out
+
+        def cached(*args, prod=None, **kwargs):
+            '''
+            (found, value) for what a call with these arguments would load, without ever calling the function.
+            '''
+            prod = default_prod if prod is None else prod
+            if prod and not use_shared:
+                return False, None
+            try:
+                save_key = make_key(args, kwargs)
+            except Exception:
+                return False, None
+            found, out = load(save_key)
+            return (True, out) if found else (False, None)
+
+        wrapped.cached = cached
         return wrapped
 
-    return decorator
\ No newline at end of file
+    return decorator
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Maintenance for the bhu_checkpoint cache.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='Copy pickle checkpoint directories into a backend.')
+    import_parser.add_argument('work_dirs', nargs='+')
+    import_parser.add_argument('--backend', default='sqlite', choices=list(BACKENDS))
+    commands.add_parser('report', help='Entries, bytes and expired entries per namespace.')
+    commands.add_parser('compact', help='Evict expired and over budget entries, then compact the storage.')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        for work_dir in args.work_dirs:
+            print(f'Imported {import_pickle_directory(work_dir, args.backend)} checkpoints from {work_dir}.')
+    else:
+        # The namespaces (and their rules) are registered by the decorators in API_Calls, on BHU.Checkpoint rather
+        # than this __main__ copy of the module.
+        import BHU.API_Calls
+        from BHU.Checkpoint import checkpoint_namespaces as registered_namespaces
+        for namespace in registered_namespaces.values():
+            if args.command == 'report':
+                print(namespace.report())
+            else:
+                print(namespace.name, namespace.compact(), namespace.report())
@@ -0,0 +1,244 @@
+import os
+import io
+import json
+import time
+import zlib
+import pickle
+from typing import List
+
+from BHU.Checkpoint import UnreadableCheckpoint
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+'''
+The checkpoints are mostly raw API responses (whole PropertyDetail documents, 200 listing Properties pages), which
+pickle big and compress really well. A Codec is a serializer plus a compressor, and plugs into bhu_checkpoint
+through the pickler / unpickler hooks it already had:
+
+    codec = get_codec('json+zstd')
+    @bhu_checkpoint(..., pickler=codec.pickler, unpickler=codec.unpickler)
+
+Everything a codec writes starts with a short header saying how it was written, and unpickler goes by that header
+rather than by its own settings, so changing BHU_CHECKPOINT_CODEC does not invalidate anything already cached.
+Anything without the header is read as a plain pickle, which is every checkpoint from before this.
+
+pickle, json and zlib are always there. msgpack, zstd (zstandard) and lz4 are used if they are installed.
+json and msgpack turn tuples into lists (and json, dict keys into strings), which is fine for API responses, and
+anything they can not encode is pickled instead.
+
+python -m BHU.Codecs ["BHU/Saved Results/Properties/" ...] compares size and load time of every codec on what is
+in the cache right now.
+'''
+
+CHECKPOINT_CODEC = os.environ.get('BHU_CHECKPOINT_CODEC', 'pickle')
+
+CODEC_MAGIC = b'BHZ\x01'
+
+SERIALIZERS = {'pickle' : 1, 'json' : 2, 'msgpack' : 3}
+COMPRESSORS = {'none' : 0, 'zlib' : 1, 'zstd' : 2, 'lz4' : 3}
+_SERIALIZER_NAMES = {v : k for k, v in SERIALIZERS.items()}
+_COMPRESSOR_NAMES = {v : k for k, v in COMPRESSORS.items()}
+
+_OPTIONAL = {'msgpack' : msgpack, 'zstd' : zstandard, 'lz4' : lz4_frame}
+_PACKAGES = {'msgpack' : 'msgpack', 'zstd' : 'zstandard', 'lz4' : 'lz4'}
+
+class CodecUnavailable(UnreadableCheckpoint):
+    '''
+    The codec a checkpoint was written with (or the one configured) needs a package that is not installed. Reading,
+    bhu_checkpoint treats it as a miss and keeps the entry, since a process that has the package can still use it.
+    '''
+    pass
+
+def available_codecs() -> List[str]:
+    serializers = [s for s in SERIALIZERS if _OPTIONAL.get(s, True) is not None]
+    compressors = [c for c in COMPRESSORS if _OPTIONAL.get(c, True) is not None]
+    return [s if c == 'none' else f'{s}+{c}' for s in serializers for c in compressors]
+
+def _serialize(serializer : str, obj) -> bytes:
+    if serializer == 'json':
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, allow_nan=True).encode('utf-8')
+    if serializer == 'msgpack':
+        return msgpack.packb(obj, use_bin_type=True)
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+def _deserialize(serializer : str, data : bytes):
+    if serializer == 'json':
+        return json.loads(data.decode('utf-8'))
+    if serializer == 'msgpack':
+        if msgpack is None:
+            raise CodecUnavailable('This checkpoint was written with msgpack, which is not installed.')
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    return pickle.loads(data)
+
+def _compress(compressor : str, data : bytes, level : int = None) -> bytes:
+    if compressor == 'zlib':
+        return zlib.compress(data, 6 if level is None else level)
+    if compressor == 'zstd':
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    if compressor == 'lz4':
+        return lz4_frame.compress(data, compression_level=0 if level is None else level)
+    return data
+
+def _decompress(compressor : str, data : bytes) -> bytes:
+    if compressor == 'zlib':
+        return zlib.decompress(data)
+    if _OPTIONAL.get(compressor, True) is None:
+        raise CodecUnavailable(f'This checkpoint was compressed with {compressor}, '
+                        f'and {_PACKAGES[compressor]} is not installed.')
+    if compressor == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compressor == 'lz4':
+        return lz4_frame.decompress(data)
+    return data
+
+def decode(data : bytes):
+    '''
+    Whatever any codec wrote (or a plain pickle) back into the object.
+    '''
+    if not data.startswith(CODEC_MAGIC):
+        return pickle.loads(data)
+    offset = len(CODEC_MAGIC)
+    serializer = _SERIALIZER_NAMES.get(data[offset])
+    compressor = _COMPRESSOR_NAMES.get(data[offset + 1])
+    if serializer is None or compressor is None:
+        # Checksum was fine, so this was written by a newer version than us.
+        raise CodecUnavailable(f'Unknown checkpoint codec {data[offset]}/{data[offset + 1]}.')
+    return _deserialize(serializer, _decompress(compressor, data[offset + 2:]))
+
+class Codec():
+    def __init__(self,
+                 serializer : str = 'pickle',
+                 compressor : str = 'none',
+                 level : int = None):
+        if serializer not in SERIALIZERS:
+            raise Exception(f'Unknown serializer {serializer}, pick from {list(SERIALIZERS)}.')
+        if compressor not in COMPRESSORS:
+            raise Exception(f'Unknown compressor {compressor}, pick from {list(COMPRESSORS)}.')
+        for name in (serializer, compressor):
+            if _OPTIONAL.get(name, True) is None:
+                raise CodecUnavailable(f'The {name} codec needs the {_PACKAGES[name]} package.')
+
+        self.serializer = serializer
+        self.compressor = compressor
+        self.level = level
+
+    def __repr__(self) -> str:
+        return f'{self.name} codec.'
+
+    @property
+    def name(self) -> str:
+        return self.serializer if self.compressor == 'none' else f'{self.serializer}+{self.compressor}'
+
+    def dumps(self, obj) -> bytes:
+        serializer = self.serializer
+        try:
+            data = _serialize(serializer, obj)
+        except (TypeError, ValueError, OverflowError):
+            if serializer == 'pickle':
+                raise
+            serializer = 'pickle'
+            data = _serialize(serializer, obj)
+        header = CODEC_MAGIC + bytes([SERIALIZERS[serializer], COMPRESSORS[self.compressor]])
+        return header + _compress(self.compressor, data, self.level)
+
+    def loads(self, data : bytes):
+        return decode(data)
+
+    # The bhu_checkpoint hooks, same signatures as pickle.dump / pickle.load.
+    def pickler(self, obj, f) -> None:
+        f.write(self.dumps(obj))
+
+    def unpickler(self, f):
+        return decode(f.read())
+
+def get_codec(name : str = CHECKPOINT_CODEC, level : int = None) -> Codec:
+    '''
+    'serializer' or 'serializer+compressor', ie 'pickle', 'json+zstd', 'msgpack+lz4'.
+    '''
+    serializer, _, compressor = name.partition('+')
+    return Codec(serializer, compressor or 'none', level)
+
+# Checked on import, so a BHU_CHECKPOINT_CODEC this machine can not write fails at startup rather than on every save.
+try:
+    checkpoint_codec = get_codec()
+except CodecUnavailable as e:
+    raise CodecUnavailable(f'BHU_CHECKPOINT_CODEC is {CHECKPOINT_CODEC}: {e}') from e
+
+def benchmark(payloads : List[bytes], codecs : List[str] = None, repeat : int = 3) -> List[dict]:
+    '''
+    payloads are stored checkpoints (any codec, or plain pickle). Each one is decoded once, then every codec
+    encodes and decodes all of them; size is the total, times are the best of repeat runs in milliseconds.
+    '''
+    objects = [decode(p) for p in payloads]
+    baseline = sum(len(_serialize('pickle', o)) for o in objects)
+    results = []
+    for name in codecs or available_codecs():
+        codec = get_codec(name)
+
+        encode_ms = float('inf')
+        for _ in range(repeat):
+            started = time.perf_counter()
+            encoded = [codec.dumps(o) for o in objects]
+            encode_ms = min(encode_ms, (time.perf_counter() - started) * 1000)
+
+        decode_ms = float('inf')
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for e in encoded:
+                codec.unpickler(io.BytesIO(e))
+            decode_ms = min(decode_ms, (time.perf_counter() - started) * 1000)
+
+        size = sum(len(e) for e in encoded)
+        results.append({
+            'codec' : name,
+            'bytes' : size,
+            'ratio' : round(baseline / size, 2) if size else None,
+            'encode_ms' : round(encode_ms, 2),
+            'decode_ms' : round(decode_ms, 2)
+        })
+    return sorted(results, key=lambda r: r['bytes'])
+
+if __name__ == '__main__':
+    import argparse
+    from BHU.Checkpoint import FileBackend, SQLiteBackend, unseal
+
+    parser = argparse.ArgumentParser(description='Compare checkpoint codecs on what is cached right now.')
+    namespaces = ['LocationSuggest', 'PropertyDetail', 'PropertyValue', 'WalkScore', 'Properties']
+    parser.add_argument('work_dirs', nargs='*', default=[f'BHU/Saved Results/{n}/' for n in namespaces])
+    parser.add_argument('--codecs', nargs='*', default=None, help=f'Default: {", ".join(available_codecs())}')
+    parser.add_argument('--sample', type=int, default=500, help='Most checkpoints to read per work_dir.')
+    args = parser.parse_args()
+
+    for work_dir in args.work_dirs:
+        if os.path.isfile(os.path.join(work_dir, SQLiteBackend.FILE_NAME)):
+            store = SQLiteBackend(work_dir)
+        else:
+            store = FileBackend(work_dir)
+        keys = [k for k in store.keys() if not k.startswith(SQLiteBackend.FILE_NAME)][:args.sample]
+        payloads = []
+        for k in keys:
+            try:
+                payloads.append(unseal(store.get(k)))
+            except Exception as e:
+                print(f'Skipping {k}: {e}')
+        if not payloads:
+            print(f'{work_dir}: nothing cached.')
+            continue
+
+        print(f'{work_dir}: {len(payloads)} checkpoints')
+        for r in benchmark(payloads, args.codecs):
+            print(f'    {r["codec"]:<16} {r["bytes"]:>12,} bytes  x{r["ratio"]:<6} '
+                  f'encode {r["encode_ms"]:>9.2f}ms  decode {r["decode_ms"]:>9.2f}ms')
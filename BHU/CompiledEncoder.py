@@ -0,0 +1,261 @@
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import MinMaxScaler, KBinsDiscretizer, OneHotEncoder, StandardScaler
+from sklearn.impute import SimpleImputer
+from typing import List
+
+import numpy as np
+
+from BHU.KerasTransformers import ToDataFrame
+
+class CompiledFeatureEncoder():
+    '''
+    Every prediction used to go feature dict -> ToDataFrame -> ColumnTransformer, which means building a one row
+    DataFrame and then walking StandardScaler, KBinsDiscretizer, OneHotEncoder and SimpleImputer one after the
+    other. That overhead was most of the time spent in predict.
+
+    This reads the fitted numbers (means, scales, bin edges, categories) out of the pipeline's preprocess step
+    once, and then goes straight from feature dicts to the model input matrix with numpy. The math is done in the
+    same order sklearn does it, so the output is the same, compile_pipeline checks that.
+    '''
+    def __init__(self,
+                 columns : List[str],
+                 blocks : List[dict]):
+        # columns are the feature dict keys read, blocks are one per ColumnTransformer transformer, in order.
+        self.columns = columns
+        self.blocks = blocks
+        self.n_features_out = sum(b['n_out'] for b in blocks)
+
+    def __repr__(self) -> str:
+        return f'Compiled encoder, {len(self.columns)} columns in, {self.n_features_out} features out.'
+
+    @classmethod
+    def from_column_transformer(cls, column_transformer):
+        columns, blocks = [], []
+        for name, transformer, cols in column_transformer.transformers_:
+            if isinstance(transformer, str) and transformer == 'drop':
+                continue
+            cols = list(cols)
+            if not len(cols):
+                continue
+            for c in cols:
+                if c not in columns:
+                    columns.append(c)
+
+            steps = transformer.steps if isinstance(transformer, Pipeline) else [(name, transformer)]
+            compiled_steps, n_out = [], len(cols)
+            for _, step in steps:
+                compiled_step, n_out = _compile_step(step, n_out)
+                compiled_steps.append(compiled_step)
+
+            blocks.append({
+                'name' : name,
+                'columns' : [columns.index(c) for c in cols],
+                'steps' : compiled_steps,
+                'n_out' : n_out
+            })
+        return cls(columns, blocks)
+
+    def transform(self, X : List[dict]) -> np.ndarray:
+        raw = np.array([[_to_float(x.get(c)) for c in self.columns] for x in X], dtype=np.float64)
+        raw = raw.reshape(len(X), len(self.columns))
+        out = np.empty((len(X), self.n_features_out), dtype=np.float64)
+
+        position = 0
+        for block in self.blocks:
+            values = raw[:, block['columns']]
+            for step in block['steps']:
+                values = STEPS[step['kind']](values, step)
+            out[:, position:position + block['n_out']] = values
+            position += block['n_out']
+        return out
+
+def _to_float(value) -> float:
+    if value is None:
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def _compile_step(step, n_in : int):
+    '''
+    Returns the step as a plain dict of arrays, and how many columns come out the other side of it.
+    '''
+    if isinstance(step, str) and step == 'passthrough':
+        return {'kind' : 'passthrough'}, n_in
+
+    if isinstance(step, SimpleImputer):
+        if step.add_indicator or not (isinstance(step.missing_values, float) and np.isnan(step.missing_values)):
+            raise Exception('Only SimpleImputer with missing_values=np.nan and no indicator can be compiled.')
+        statistics = np.asarray(step.statistics_, dtype=np.float64)
+        # Like sklearn, columns that were all missing during fit are dropped.
+        keep = np.flatnonzero(~np.isnan(statistics))
+        return {'kind' : 'impute', 'statistics' : statistics[keep], 'keep' : keep}, len(keep)
+
+    if isinstance(step, StandardScaler):
+        return {
+            'kind' : 'standard',
+            'mean' : None if step.mean_ is None or not step.with_mean else np.asarray(step.mean_),
+            'scale' : None if step.scale_ is None or not step.with_std else np.asarray(step.scale_)
+        }, n_in
+
+    if isinstance(step, MinMaxScaler):
+        return {
+            'kind' : 'minmax',
+            'scale' : np.asarray(step.scale_),
+            'min' : np.asarray(step.min_),
+            'clip' : bool(step.clip),
+            'feature_range' : step.feature_range
+        }, n_in
+
+    if isinstance(step, KBinsDiscretizer):
+        n_bins = [int(n) for n in step.n_bins_]
+        return {
+            'kind' : 'bins',
+            'inner_edges' : [np.asarray(e[1:-1]) for e in step.bin_edges_],
+            'n_bins' : n_bins,
+            'onehot' : step.encode != 'ordinal'
+        }, sum(n_bins) if step.encode != 'ordinal' else n_in
+
+    if isinstance(step, OneHotEncoder):
+        if step.drop is not None or getattr(step, '_infrequent_enabled', False):
+            raise Exception('OneHotEncoder with drop or infrequent categories can not be compiled.')
+        categories = [np.asarray(c) for c in step.categories_]
+        if any(c.dtype.kind not in 'biuf' for c in categories):
+            raise Exception('Only numeric OneHotEncoder categories can be compiled.')
+        return {
+            'kind' : 'onehot',
+            'categories' : [c.astype(np.float64) for c in categories],
+            'handle_unknown' : step.handle_unknown
+        }, sum(len(c) for c in categories)
+
+    raise Exception(f'Do not know how to compile {type(step).__name__}.')
+
+def _impute(X, step):
+    X = X[:, step['keep']]
+    missing = np.isnan(X)
+    if missing.any():
+        X = np.where(missing, step['statistics'], X)
+    return X
+
+def _standard(X, step):
+    X = X.copy()
+    if step['mean'] is not None:
+        X -= step['mean']
+    if step['scale'] is not None:
+        X /= step['scale']
+    return X
+
+def _minmax(X, step):
+    X = X * step['scale']
+    X += step['min']
+    if step['clip']:
+        np.clip(X, step['feature_range'][0], step['feature_range'][1], out=X)
+    return X
+
+def _bins(X, step):
+    binned = np.column_stack([
+        np.searchsorted(edges, X[:, j], side='right') for j, edges in enumerate(step['inner_edges'])
+    ])
+    if not step['onehot']:
+        return binned.astype(np.float64)
+    out = np.zeros((X.shape[0], sum(step['n_bins'])), dtype=np.float64)
+    offsets = np.cumsum([0] + step['n_bins'][:-1])
+    rows = np.arange(X.shape[0])
+    for j, offset in enumerate(offsets):
+        out[rows, offset + binned[:, j]] = 1.0
+    return out
+
+def _onehot(X, step):
+    out = np.zeros((X.shape[0], sum(len(c) for c in step['categories'])), dtype=np.float64)
+    offset = 0
+    for j, categories in enumerate(step['categories']):
+        matches = (X[:, [j]] == categories) | (np.isnan(X[:, [j]]) & np.isnan(categories))
+        unknown = ~matches.any(axis=1)
+        if unknown.any() and step['handle_unknown'] == 'error':
+            raise ValueError(f'Found unknown categories {X[unknown, j]} in column {j} during transform.')
+        out[:, offset:offset + len(categories)] = matches
+        offset += len(categories)
+    return out
+
+STEPS = {
+    'passthrough' : lambda X, step: X,
+    'impute' : _impute,
+    'standard' : _standard,
+    'minmax' : _minmax,
+    'bins' : _bins,
+    'onehot' : _onehot
+}
+
+class CompiledPipeline():
+    '''
+    The serve time stand in for the whole pipeline, compiled encoder then model. Has the same predict as the
+    sklearn pipeline, so the registry and KerasModelToggle can use either.
+    '''
+    def __init__(self,
+                 encoder : CompiledFeatureEncoder,
+                 model):
+        self.encoder = encoder
+        self.model = model
+
+    def __repr__(self) -> str:
+        return f'Compiled pipeline: {self.encoder} -> {type(self.model).__name__}'
+
+    def predict(self, X : List[dict]):
+        return self.model.predict(self.encoder.transform(X))
+
+def compile_pipeline(pipeline : Pipeline, X : List[dict] = None, atol : float = 0.0) -> CompiledPipeline:
+    '''
+    Takes a fitted pipeline (ToDataFrame, preprocess, model) and returns the CompiledPipeline for it.
+    If X is passed, the compiled encoder is checked against ToDataFrame + the ColumnTransformer on it.
+    '''
+    encoder = CompiledFeatureEncoder.from_column_transformer(pipeline.named_steps['preprocess'])
+    if X is not None:
+        verify_compiled_encoder(pipeline, encoder, X, atol)
+    return CompiledPipeline(encoder, pipeline.steps[-1][1])
+
+def bin_edge_rows(pipeline : Pipeline, X : List[dict]) -> List[dict]:
+    '''
+    Copies of the first row of X with each bucketized column set to each of its bin edges, and the floats either
+    side of it. Edges are the only place searchsorted and the pinned sklearn's KBinsDiscretizer can disagree, and
+    sampled or real rows almost never land on one.
+    '''
+    if not X:
+        return []
+    rows = []
+    for _, transformer, cols in pipeline.named_steps['preprocess'].transformers_:
+        steps = transformer.steps if isinstance(transformer, Pipeline) else [('', transformer)]
+        for i, (_, step) in enumerate(steps):
+            # Only when nothing before the bins changes a value that is there, otherwise the edges mean nothing
+            # for the raw column.
+            if not isinstance(step, KBinsDiscretizer) or \
+                    not all(isinstance(s, SimpleImputer) for _, s in steps[:i]):
+                continue
+            for j, c in enumerate(cols):
+                for edge in step.bin_edges_[j]:
+                    for value in (np.nextafter(edge, -np.inf), edge, np.nextafter(edge, np.inf)):
+                        rows.append({**X[0], c : float(value)})
+    return rows
+
+def verify_compiled_encoder(pipeline : Pipeline, encoder : CompiledFeatureEncoder, X : List[dict],
+                            atol : float = 0.0) -> float:
+    '''
+    Blows up if the compiled encoder does not give the same model input as the sklearn path, on X plus
+    bin_edge_rows. Returns the largest absolute difference, which should be zero.
+    '''
+    X = list(X) + bin_edge_rows(pipeline, X)
+    # Unique ids so ToDataFrame does not drop any of the rows we are comparing.
+    X = [{**x, 'Property_ID' : i} for i, x in enumerate(X)]
+    expected = pipeline.named_steps['preprocess'].transform(ToDataFrame().transform(X))
+    if hasattr(expected, 'toarray'):
+        expected = expected.toarray()
+    expected = np.asarray(expected, dtype=np.float64)
+    compiled = encoder.transform(X)
+
+    if expected.shape != compiled.shape:
+        raise Exception(f'Compiled encoder shape {compiled.shape} does not match sklearn shape {expected.shape}.')
+
+    worst = float(np.max(np.abs(expected - compiled))) if expected.size else 0.0
+    if worst > atol:
+        raise Exception(f'Compiled encoder is off from the sklearn path by up to {worst:.2e}.')
+    return worst
@@ -1,7 +1,9 @@
 #type:ignore
 from BHU.House import House
 from BHU.API_Calls import *
+from BHU.WalkScoreCache import walk_score_cache
 from typing import Tuple, List
+from concurrent.futures import ThreadPoolExecutor
 from math import radians, cos, sin, asin, sqrt, atan2
 from scipy.stats.mstats import winsorize
 from sklearn.impute import SimpleImputer
@@ -11,6 +13,10 @@ import numpy as np
 import pickle
 import os
 
+# How many walk score calls are in flight at once when building a new city's walk score model. The rate limiter in
+# BHU.RateLimit still decides how fast they actually go out.
+WALK_SCORE_CONCURRENCY = int(os.environ.get('BHU_WALK_SCORE_CONCURRENCY', 8))
+
 # This will take in house and geo, and generate stats based on what is fed, and then can output a dictionary that 
 # can easily be converted into a pd.Dataframe for the pipeline.
 class FeatureGenerator():
@@ -112,23 +118,30 @@ class FeatureGenerator():
         return
 
     def _sync_walk_score(self) -> None:
-        # If I want to multithread, this is where we need to do it.
-        # If I do this, I am going to lose order, so maybe return the property id?
-
         # I will always need to get the walkscore of the user.
         user_ws = self._get_walk_score(self.user_home_formatted)
         self.user_home_formatted.walk_score = user_ws.get('walk_score') or 50
 
+        # These are independent calls, so run them on a pool and match them back up by property id. The houses
+        # were de-duplicated on property id in __init__, so the ids are unique.
+        with ThreadPoolExecutor(max_workers=WALK_SCORE_CONCURRENCY) as pool:
+            futures = {h.reference_info.get('id') : pool.submit(self._get_walk_score, h) for h in self.houses}
+
         # If we end up expanding to transit or biking, here is where that happens
         for h in self.houses:
-            ws = self._get_walk_score(h)
+            try:
+                ws = futures[h.reference_info.get('id')].result()
+            except Exception as e:
+                print(f'Walk score failed for {h.reference_info.get("id")}, using the default: {e}')
+                ws = {}
             h.walk_score = ws.get('walk_score') or 50
 
         return
     
     def _get_walk_score(self, h) -> House:
         # If this is tripped, we know we do not have a model, so generate it.
-        walk_score_raw = get_WalkScore(
+        # Houses on the same block share a score, see BHU.WalkScoreCache.
+        walk_score_raw = walk_score_cache.get(
             address=f'{h.city} {h.state}',
             lat=h.lat_long[0],
             lon=h.lat_long[1]
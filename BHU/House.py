@@ -2,7 +2,8 @@
 from typing import Literal, Tuple
 from datetime import datetime
 import numpy as np
-from BHU.API_Calls import get_PropertyValue, get_WalkScore
+from BHU.API_Calls import get_PropertyValue
+from BHU.WalkScoreCache import walk_score_cache
 
 class House():
     '''
@@ -268,7 +269,7 @@ class House():
         return
 
     def _get_user_walksore(self) -> float:
-        walk_score_raw = get_WalkScore(
+        walk_score_raw = walk_score_cache.get(
             address=f'{self.city} {self.state}',
             lat=self.lat_long[0],
             lon=self.lat_long[1]
@@ -0,0 +1,268 @@
+import os
+import json
+import stat
+import socket
+import struct
+import time
+import threading
+import socketserver
+from typing import List
+
+import numpy as np
+
+from BHU.KerasTransformers import MODEL_FEATURE_COLUMNS
+from BHU.ModelRegistry import ModelRegistry, model_registry, warm_up_row
+from BHU.PredictionDispatcher import PredictionDispatcher
+
+'''
+Every gunicorn worker that imports BHU gets its own copy of every city pipeline (and TensorFlow, if the pipeline
+has not been exported to numpy). This lets one long lived process own the models and the web workers ask it for
+predictions over a local Unix socket, so adding web workers does not add model memory.
+
+    python -m BHU.InferenceServer --socket /tmp/bhu_inference.sock
+    BHU_INFERENCE_SOCKET=/tmp/bhu_inference.sock gunicorn app:app
+
+The socket is made 0600, so the web workers have to run as the same user as the server.
+
+The wire format is as small as I could make it. Every message is a 4 byte big endian length and then the payload.
+Requests:
+    P | model name length (H) | rows (I) | columns (H) | model name | rows x columns little endian float64
+    L (list the models available)
+The float64 matrix is MODEL_FEATURE_COLUMNS in order, NaN for anything missing.
+Responses:
+    0x00 | payload    P: rows (I) | rows little endian float64,  L: JSON list of model names
+    0x01 | utf-8 error message
+'''
+
+INFERENCE_SOCKET = os.environ.get('BHU_INFERENCE_SOCKET', '/tmp/bhu_inference.sock')
+
+OP_PREDICT = b'P'
+OP_LIST = b'L'
+STATUS_OK = b'\x00'
+STATUS_ERROR = b'\x01'
+
+_LENGTH = struct.Struct('!I')
+_PREDICT_HEADER = struct.Struct('!HIH')
+_ROWS = struct.Struct('!I')
+
+def _recv_exactly(sock : socket.socket, n : int) -> bytes:
+    buffer = bytearray()
+    while len(buffer) < n:
+        chunk = sock.recv(n - len(buffer))
+        if not chunk:
+            raise ConnectionError('Inference socket closed mid message.')
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+def _recv_message(sock : socket.socket) -> bytes:
+    (length,) = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    return _recv_exactly(sock, length)
+
+def _send_message(sock : socket.socket, payload : bytes) -> None:
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+def _to_float(value) -> float:
+    if value is None:
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def encode_predict_request(model_name : str, rows : List[dict], columns : List[str] = MODEL_FEATURE_COLUMNS) -> bytes:
+    name = model_name.encode('utf-8')
+    matrix = np.array([[_to_float(r.get(c)) for c in columns] for r in rows], dtype='<f8')
+    return OP_PREDICT + _PREDICT_HEADER.pack(len(name), len(rows), len(columns)) + name + matrix.tobytes()
+
+def decode_predict_request(payload : bytes, columns : List[str] = MODEL_FEATURE_COLUMNS):
+    name_length, n_rows, n_cols = _PREDICT_HEADER.unpack_from(payload, 1)
+    if n_cols != len(columns):
+        raise ValueError(f'Expected {len(columns)} feature columns, got {n_cols}.')
+    offset = 1 + _PREDICT_HEADER.size
+    model_name = payload[offset:offset + name_length].decode('utf-8')
+    matrix = np.frombuffer(payload, dtype='<f8', count=n_rows * n_cols, offset=offset + name_length)
+    rows = [dict(zip(columns, r)) for r in matrix.reshape(n_rows, n_cols).tolist()]
+    return model_name, rows
+
+class _InferenceHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # Connections are kept open, one message after another until the client hangs up.
+        while True:
+            try:
+                payload = _recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            _send_message(self.request, self.server.respond(payload))
+
+def _remove_stale_socket(socket_path : str) -> None:
+    '''
+    A server that died without cleaning up leaves its socket behind, and bind fails on it. Only that gets removed,
+    never a regular file, or the socket of a server that is still answering.
+    '''
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise Exception(f'{socket_path} is in the way and is not a socket.')
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        os.remove(socket_path)
+        return
+    finally:
+        probe.close()
+    raise Exception(f'An inference server is already running on {socket_path}.')
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Owns the models. Each connection gets a thread, and predictions go through a PredictionDispatcher so requests
+    from different web workers for the same city get batched together.
+    '''
+    daemon_threads = True
+
+    def __init__(self,
+                 socket_path : str = INFERENCE_SOCKET,
+                 registry : ModelRegistry = model_registry,
+                 dispatcher : PredictionDispatcher = None):
+        self.socket_path = socket_path
+        self.registry = registry
+        self.dispatcher = dispatcher or PredictionDispatcher(registry)
+
+        _remove_stale_socket(socket_path)
+        # Nobody else gets to connect, not even between bind and a chmod.
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _InferenceHandler)
+        finally:
+            os.umask(umask)
+
+    def respond(self, payload : bytes) -> bytes:
+        try:
+            op = payload[:1]
+            if op == OP_PREDICT:
+                model_name, rows = decode_predict_request(payload)
+                predictions = np.asarray(self.dispatcher.predict(model_name, rows), dtype='<f8')
+                return STATUS_OK + _ROWS.pack(len(predictions)) + predictions.tobytes()
+            if op == OP_LIST:
+                return STATUS_OK + json.dumps(self.registry.available_models()).encode('utf-8')
+            raise ValueError(f'Unknown inference op {op!r}.')
+        except Exception as e:
+            return STATUS_ERROR + str(e).encode('utf-8')
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+class InferenceClient():
+    '''
+    The web worker side. It quacks like the ModelRegistry (available_models, is_available, get), so it can be
+    handed to the PredictionDispatcher, the bulk endpoint, etc. in its place. One connection per thread.
+    '''
+    def __init__(self,
+                 socket_path : str = INFERENCE_SOCKET,
+                 timeout : float = 30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+        self._local = threading.local()
+        self._available_models : List[str] = None
+
+    def __repr__(self) -> str:
+        return f'Inference client on {self.socket_path}.'
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+    def _request(self, payload : bytes) -> bytes:
+        # If the server was restarted our connection is stale, so reconnect once before giving up.
+        for attempt in range(2):
+            sock = getattr(self._local, 'sock', None)
+            try:
+                if sock is None:
+                    sock = self._local.sock = self._connect()
+                _send_message(sock, payload)
+                response = _recv_message(sock)
+                break
+            except (ConnectionError, OSError):
+                if sock is not None:
+                    sock.close()
+                self._local.sock = None
+                if attempt:
+                    raise
+
+        if response[:1] != STATUS_OK:
+            raise Exception(f'Inference server error: {response[1:].decode("utf-8")}')
+        return response[1:]
+
+    def predict(self, model_name : str, rows : List[dict]) -> np.ndarray:
+        response = self._request(encode_predict_request(model_name, rows))
+        (n_rows,) = _ROWS.unpack_from(response)
+        return np.frombuffer(response, dtype='<f8', count=n_rows, offset=_ROWS.size).astype(float)
+
+    def available_models(self) -> List[str]:
+        if self._available_models is None:
+            self._available_models = json.loads(self._request(OP_LIST).decode('utf-8'))
+        return self._available_models
+
+    def is_available(self, model_name : str) -> bool:
+        return model_name in self.available_models()
+
+    def get(self, model_name : str):
+        return RemoteModel(self, model_name)
+
+    def warm_up(self, wait : float = 120.0) -> None:
+        '''
+        Waits (up to wait seconds) for the inference server to come up, then runs a prediction through every
+        model it has, which also warms them up on the server side.
+        '''
+        deadline = time.monotonic() + wait
+        while True:
+            try:
+                model_names = self.available_models()
+                break
+            except (ConnectionError, OSError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+
+        for model_name in model_names:
+            self.predict(model_name, [warm_up_row()])
+
+class RemoteModel():
+    '''
+    Looks like a pipeline (predict returns one row per input, one column), but runs in the inference server.
+    '''
+    def __init__(self,
+                 client : InferenceClient,
+                 model_name : str):
+        self.client = client
+        self.model_name = model_name
+
+    def __repr__(self) -> str:
+        return f'Remote {self.model_name} model.'
+
+    def predict(self, X : List[dict]) -> np.ndarray:
+        return self.client.predict(self.model_name, list(X)).reshape(-1, 1)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve BHU model predictions over a Unix socket.')
+    parser.add_argument('--socket', default=INFERENCE_SOCKET)
+    args = parser.parse_args()
+
+    server = InferenceServer(args.socket)
+    server.registry.warm_up()
+    print(f'Serving {", ".join(server.registry.available_models())} on {args.socket}.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,184 @@
+#type:ignore
+import os
+import json
+import pickle
+from datetime import datetime
+from typing import Literal, List
+
+from retrying import retry
+
+from BHU.API_Calls import RESULTS_PER_REQUEST_LIMIT, _properties_request, _get_page_results, _retry_unless_rate_limited
+
+'''
+Refreshing a city through get_Properties means pulling every page again, and query_url's checkpoint never updates
+anyway. This keeps a dataset per city and market status, keyed by property_id, plus a cursor with the newest
+list_date (for sale) or sold_date (sold) we have seen. A refresh walks the newest / sold_date sorted search from the
+top and stops at the first page that gets back to the cursor, so a nightly run is a few requests.
+
+If max_pages runs out first, the cursor stays where it was and the next run carries on from the page we stopped at
+(resume), so nothing between the two gets skipped. The cursor only moves once a walk gets all the way back to it.
+
+    BHU/Saved Results/Ingestion/SEATTLE_WA/
+        for_sale.pkl    {property_id : listing}
+        sold.pkl
+        cursor.json     {"for_sale" : {"cursor" : "2023-02-01", "resume" : null, ...}, "sold" : {...}}
+
+python -m BHU.Ingestion Seattle WA [--market-status sold] [--max-pages 5] [--full]
+'''
+
+INGESTION_LOCATION = 'BHU/Saved Results/Ingestion/'
+MARKET_STATUSES = ['for_sale', 'sold']
+
+_get_page = retry(stop_max_attempt_number=5, retry_on_exception=_retry_unless_rate_limited)(_get_page_results)
+
+def city_directory(city : str, state_code : str, location : str = INGESTION_LOCATION) -> str:
+    return os.path.join(location, f'{city.upper()}_{state_code.upper()}')
+
+def _listing_date(listing : dict, market_status : str) -> str:
+    '''
+    The date the search is sorted on, as YYYY-MM-DD (the API is not consistent about including a time).
+    '''
+    description = listing.get('description') or {}
+    if market_status == 'sold':
+        date = listing.get('sold_date') or description.get('sold_date') or listing.get('list_date')
+    else:
+        date = listing.get('list_date')
+    return str(date)[:10] if date else None
+
+def _write_atomic(path : str, data : bytes) -> None:
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+def load_cursor(city : str, state_code : str, location : str = INGESTION_LOCATION) -> dict:
+    path = os.path.join(city_directory(city, state_code, location), 'cursor.json')
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def load_dataset(city : str, state_code : str, market_status : Literal['for_sale','sold'],
+                 location : str = INGESTION_LOCATION) -> dict:
+    path = os.path.join(city_directory(city, state_code, location), f'{market_status}.pkl')
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def load_listings(city : str, state_code : str, market_status : Literal['for_sale','sold'],
+                  location : str = INGESTION_LOCATION) -> List[dict]:
+    '''
+    The stored listings newest first, the same shape get_Properties returns in 'houses'.
+    '''
+    dataset = load_dataset(city, state_code, market_status, location)
+    return sorted(dataset.values(), key=lambda l: _listing_date(l, market_status) or '', reverse=True)
+
+def ingest_city(
+        city          : str,
+        state_code    : str,
+        market_status : Literal['for_sale','sold'] = 'for_sale',
+        max_pages     : int = None,
+        full          : bool = False,
+        property_type : str = 'single_family',
+        location      : str = INGESTION_LOCATION,
+        verbose       : bool = False
+    ) -> dict:
+    '''
+    Brings the stored dataset for a city up to date and returns what it did.
+
+    max_pages - Stop after this many requests no matter what, mostly for the first run of a big city. The next run
+        picks up where this one stopped.
+    full - Ignore the cursor (and any resume) and walk every page (or max_pages). Listings are still upserted,
+        nothing is dropped.
+    '''
+    if market_status not in MARKET_STATUSES:
+        raise Exception(f'market_status has to be one of {MARKET_STATUSES}.')
+
+    directory = city_directory(city, state_code, location)
+    os.makedirs(directory, exist_ok=True)
+
+    cursors = load_cursor(city, state_code, location)
+    state = cursors.get(market_status, {})
+    cursor = None if full else state.get('cursor')
+    resume = None if full else state.get('resume')
+    dataset = load_dataset(city, state_code, market_status, location)
+
+    url, querystring = _properties_request(market_status, city_state=(city, state_code), property_type=property_type)
+    v2 : bool = 'v2' in url
+
+    n_requests, n_new, n_updated = 0, 0, 0
+    # When resuming, the top of the search was covered by the run that stopped, up to its newest. Anything listed
+    # since is above that and gets picked up next time, as long as the cursor does not go past it.
+    newest = resume['newest'] if resume else cursor
+    offset = resume['offset'] if resume else 0
+    finished = False
+    while max_pages is None or n_requests < max_pages:
+        page_querystring = querystring.copy()
+        page_querystring['offset'] = str(offset)
+        houses = _get_page(url, page_querystring, v2)
+        n_requests += 1
+
+        reached_cursor = False
+        for listing in houses:
+            property_id = listing.get('property_id')
+            if not property_id:
+                continue
+
+            date = _listing_date(listing, market_status)
+            if cursor is not None and date is not None and date < cursor:
+                reached_cursor = True
+                continue
+
+            if property_id in dataset:
+                n_updated += 1
+            else:
+                n_new += 1
+            dataset[property_id] = listing
+
+            if resume is None and date is not None and (newest is None or date > newest):
+                newest = date
+
+        if verbose:
+            print(f'{city}, {state_code} {market_status} offset {offset}: {len(houses)} listings.')
+
+        if reached_cursor or len(houses) < RESULTS_PER_REQUEST_LIMIT:
+            finished = True
+            break
+        offset += RESULTS_PER_REQUEST_LIMIT
+
+    # The dataset goes first, so the cursor never says we have listings that did not get saved.
+    _write_atomic(os.path.join(directory, f'{market_status}.pkl'), pickle.dumps(dataset))
+    cursors[market_status] = {
+        'cursor' : newest if finished else state.get('cursor'),
+        'resume' : None if finished else {'offset' : offset, 'newest' : newest},
+        'refreshed' : datetime.now().isoformat(timespec='seconds'),
+        'listings' : len(dataset)
+    }
+    _write_atomic(os.path.join(directory, 'cursor.json'), json.dumps(cursors, indent=1).encode('utf-8'))
+
+    return {
+        'city' : city,
+        'state_code' : state_code,
+        'market_status' : market_status,
+        'requests' : n_requests,
+        'new' : n_new,
+        'updated' : n_updated,
+        'listings' : len(dataset),
+        'cursor' : cursors[market_status]['cursor'],
+        'finished' : finished
+    }
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Incrementally refresh the stored listings for a city.')
+    parser.add_argument('city')
+    parser.add_argument('state_code')
+    parser.add_argument('--market-status', choices=MARKET_STATUSES + ['both'], default='both')
+    parser.add_argument('--max-pages', type=int, default=None)
+    parser.add_argument('--full', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    market_statuses = MARKET_STATUSES if args.market_status == 'both' else [args.market_status]
+    for market_status in market_statuses:
+        print(ingest_city(args.city, args.state_code, market_status, args.max_pages, args.full, verbose=args.verbose))
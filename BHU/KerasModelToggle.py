@@ -1,4 +1,10 @@
 from sklearn.pipeline import Pipeline
+from itertools import product
+from typing import Iterable, List
+
+from BHU.KerasTransformers import predict_rows
+
+GRID_ATTRIBUTES = ['beds', 'baths_full', 'baths_3qtr', 'baths_half', 'baths_1qtr', 'garage']
 
 def format_number_as_dollar(value):
     round_to_the_nearest = 5000
@@ -63,14 +69,57 @@ class KerasModelToggle():
         This will take whatever the current orientation is.
         '''
         self.predicted_new_value = float(self.model.predict([self.user_features_mod])[0][0])
+        return self._price_stats(self.predicted_new_value)
+
+    def sensitivity_grid(self,
+                         beds : Iterable[int] = None,
+                         baths_full : Iterable[int] = None,
+                         baths_3qtr : Iterable[int] = None,
+                         baths_half : Iterable[int] = None,
+                         baths_1qtr : Iterable[int] = None,
+                         garage : Iterable[int] = None,
+                         top_n : int = None) -> List[dict]:
+        '''
+        Instead of the user guessing one upgrade at a time, this scores every combination of the ranges passed in
+        with a single predict call. Anything left as None stays at what the user confirmed for their house.
+        Returns a list of the combinations with the same price stats as predit_new_value, best dollar delta first.
+        '''
+        ranges = {
+            'beds' : beds,
+            'baths_full' : baths_full,
+            'baths_3qtr' : baths_3qtr,
+            'baths_half' : baths_half,
+            'baths_1qtr' : baths_1qtr,
+            'garage' : garage
+        }
+        ranges = {k : [self.user_features.get(k, 0)] if v is None else list(v) for k, v in ranges.items()}
+
+        combinations = [dict(zip(GRID_ATTRIBUTES, c)) for c in product(*[ranges[k] for k in GRID_ATTRIBUTES])]
+        if not len(combinations):
+            return []
+
+        rows = []
+        for c in combinations:
+            row = self.user_features.copy()
+            row.update(c)
+            row['bathrooms'] = row['baths_full'] + 0.75 * row['baths_3qtr'] + \
+                0.5 * row['baths_half'] + 0.25 * row['baths_1qtr']
+            rows.append(row)
+
+        predictions = predict_rows(self.model, rows)
+
+        surface = [{**c, **self._price_stats(float(p))} for c, p in zip(combinations, predictions)]
+        surface.sort(key=lambda d: d['dollar_delta'], reverse=True)
+        return surface if top_n is None else surface[:top_n]
 
-        scaled_new_value = self.predicted_new_value * self.price_ratio
+    def _price_stats(self, predicted_new_value : float) -> dict:
+        scaled_new_value = predicted_new_value * self.price_ratio
         dollar_delta = scaled_new_value - self.user_price
-        pct_delta = float(self.predicted_new_value / self.model_predicted_user_price)
+        pct_delta = float(predicted_new_value / self.model_predicted_user_price)
 
         return {
             'scaled_new_value' : scaled_new_value,
-            '_new_value' : self.predicted_new_value,
+            '_new_value' : predicted_new_value,
             'dollar_delta' : dollar_delta,
             'pct_delta' : pct_delta,
             '_user_price_ratio' : self.price_ratio,
@@ -11,7 +11,6 @@ from sklearn.preprocessing import MinMaxScaler, KBinsDiscretizer, OneHotEncoder,
 from sklearn.impute import SimpleImputer
 from sklearn.feature_extraction import DictVectorizer
 
-from BHU.KerasModel import KerasModel
 from joblib import load
 
 '''
@@ -78,25 +77,31 @@ preprocess_year_col = Pipeline(
     ]
 )
 
+NORMALIZE_COLS = ['lot_sqft', 'sqft']
+BUCKETIZE_COLS = ['lat_winz', 'long_winz', 'year_built']
+WALK_SCORE_COLS = ['walk_score']
+DUMMY_COLS = ['garage', 'new_construction']
+BATHROOM_COLS = ['bathrooms']
+ATTRIBUTE_COLS = ['beds', 'stories']
+
+# Everything the model actually looks at, the rest of the feature dict is along for the ride.
+MODEL_FEATURE_COLUMNS = NORMALIZE_COLS + BUCKETIZE_COLS + WALK_SCORE_COLS + DUMMY_COLS + BATHROOM_COLS + ATTRIBUTE_COLS
+
 def generate_keras_pipeline(model_name, scaler):
-    normalize_cols = ['lot_sqft', 'sqft']
-    bucketize_cols = ['lat_winz', 'long_winz', 'year_built']
-    walk_score = ['walk_score']
-    dummy_cols = ['garage', 'new_construction']
-    bathtooms = ['bathrooms']
-    attribute_cols = ['beds', 'stories']
+    # Imported here so that loading a pipeline without a KerasModel step does not drag in TensorFlow.
+    from BHU.KerasModel import KerasModel
 
     # Do I put the bathrooms back in if we have an aggregate value?
 
     preprocess_data = ColumnTransformer(
         [
-            ('normalize', StandardScaler(), normalize_cols),
-            ('bucketize', preprocess_bucketize_col, bucketize_cols),
-            ('dummy', OneHotEncoder(sparse_output=False, handle_unknown='ignore'), dummy_cols),
-            # ('walkscore_mm', preprocess_min_max_cols, walk_score),
-            ('bathrooms', preprocess_min_max_cols, bathtooms),
-            ('walkscore_ss', preprocess_standard_scaler_cols, walk_score),
-            ('toggle_attributes', preprocess_standard_scaler_cols, attribute_cols)
+            ('normalize', StandardScaler(), NORMALIZE_COLS),
+            ('bucketize', preprocess_bucketize_col, BUCKETIZE_COLS),
+            ('dummy', OneHotEncoder(sparse_output=False, handle_unknown='ignore'), DUMMY_COLS),
+            # ('walkscore_mm', preprocess_min_max_cols, WALK_SCORE_COLS),
+            ('bathrooms', preprocess_min_max_cols, BATHROOM_COLS),
+            ('walkscore_ss', preprocess_standard_scaler_cols, WALK_SCORE_COLS),
+            ('toggle_attributes', preprocess_standard_scaler_cols, ATTRIBUTE_COLS)
             #('dates', preprocess_year_col, year_cols)
         ]
     )
@@ -123,4 +128,53 @@ def train_keras_pipeline(model_name, X, y, scaler):
     return keras_pipeline.fit(X, y)
 
 def get_keras_pipeline_from_file(model_name):
-    return load(f'BHU/Production_Models/Pipeline/{model_name}.joblib')
\ No newline at end of file
+    return load(f'BHU/Production_Models/Pipeline/{model_name}.joblib')
+
+def sample_feature_rows(pipeline, n : int = 100, seed : int = 0):
+    '''
+    Makes up n plausible feature dicts from what the fitted preprocessing step learned (means, scales, bin edges,
+    categories). This is not for modeling, it is for checking one version of a pipeline against another, or just
+    pushing something through predict.
+    '''
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for _, transformer, cols in pipeline.named_steps['preprocess'].transformers_:
+        if transformer in ['drop', 'passthrough']:
+            continue
+        for j, c in enumerate(cols):
+            columns[c] = _sample_column(transformer, j, n, rng).tolist()
+
+    rows = [{c : v[i] for c, v in columns.items()} for i in range(n)]
+    for i, r in enumerate(rows):
+        r['Property_ID'] = f'SAMPLE_{i}'
+    return rows
+
+def _sample_column(transformer, j : int, n : int, rng) -> np.ndarray:
+    steps = transformer.steps if isinstance(transformer, Pipeline) else [('', transformer)]
+    # The last step that learned anything about the column tells us the most about it.
+    for _, step in steps[::-1]:
+        if isinstance(step, StandardScaler) and step.mean_ is not None:
+            return rng.normal(step.mean_[j], 1 if step.scale_ is None else step.scale_[j], n)
+        if isinstance(step, MinMaxScaler):
+            return rng.uniform(step.data_min_[j], step.data_max_[j], n)
+        if isinstance(step, KBinsDiscretizer):
+            return rng.uniform(step.bin_edges_[j][0], step.bin_edges_[j][-1], n)
+        if isinstance(step, OneHotEncoder):
+            return rng.choice(step.categories_[j], n)
+        if isinstance(step, SimpleImputer):
+            return np.full(n, step.statistics_[j])
+    return np.zeros(n)
+
+def with_unique_property_ids(rows):
+    '''
+    ToDataFrame drops duplicate Property_IDs, which is right for training but wrong when we are scoring a bunch of
+    variations of the same house in one go, we would only get one prediction back. Property_ID is not a model
+    feature, so each row just gets its position tacked on.
+    '''
+    return [{**r, 'Property_ID' : f'{r.get("Property_ID")}_{i}'} for i, r in enumerate(rows)]
+
+def predict_rows(model, rows) -> np.ndarray:
+    '''
+    Runs every row through the pipeline in a single predict call and returns a flat array, one value per row.
+    '''
+    return np.asarray(model.predict(with_unique_property_ids(rows)), dtype=float).reshape(-1)
\ No newline at end of file
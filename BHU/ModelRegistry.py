@@ -0,0 +1,106 @@
+import os
+import threading
+from typing import Callable, Dict, List
+
+from BHU.KerasTransformers import MODEL_FEATURE_COLUMNS, get_keras_pipeline_from_file, predict_rows
+
+MODEL_LOCATION = 'BHU/Production_Models/Pipeline/'
+
+def load_serving_pipeline(model_name : str):
+    '''
+    BHU_MODEL_PRECISION picks a quantized export (float16 / int8) if that has been made, falling back to float32.
+    The precision wins over the format, and for each precision we serve, in order of preference:
+        the memory mapped store (python -m BHU.ModelStore), shared between every process on the box
+        the numpy export (python -m BHU.NumpyModel), which does not need TensorFlow
+    and the Keras pipeline if there is neither.
+    '''
+    from BHU.NumpyModel import MODEL_PRECISION, numpy_model_file_path, get_numpy_pipeline_from_file
+    from BHU.ModelStore import model_store_path, load_model_store
+    precisions = list(dict.fromkeys([MODEL_PRECISION, 'float32']))
+    for precision in precisions:
+        if os.path.isfile(os.path.join(model_store_path(model_name, precision), 'manifest.json')):
+            return load_model_store(model_name, precision)
+        if os.path.isfile(numpy_model_file_path(model_name, precision)):
+            return get_numpy_pipeline_from_file(model_name, precision)
+    return get_keras_pipeline_from_file(model_name)
+
+def warm_up_row() -> dict:
+    '''
+    Not a real house, just something every model can push through predict.
+    '''
+    return {'Property_ID' : 'WARM_UP', **{c : 0 for c in MODEL_FEATURE_COLUMNS}}
+
+class ModelRegistry():
+    '''
+    Every time someone hit submit on the toggle page we were doing a joblib.load on the city pipeline, which also
+    rebuilds the whole Keras graph. This holds on to each pipeline once it has been loaded, keyed by model name
+    (ie SEATTLE_WA), so every request in the worker shares the same one.
+
+    The available models are read off of disk once, the first time anyone asks, rather than on every request.
+    '''
+    def __init__(self,
+                 model_location : str = MODEL_LOCATION,
+                 loader : Callable = load_serving_pipeline
+                 ):
+        self.model_location = model_location
+        self.loader = loader
+
+        self._models : Dict[str, object] = {}
+        self._available_models : List[str] = None
+        self._lock = threading.Lock()
+        self._model_locks : Dict[str, threading.Lock] = {}
+
+    def __repr__(self) -> str:
+        return f'Model registry with {len(self._models)} of {len(self.available_models())} models loaded.'
+
+    def available_models(self) -> List[str]:
+        if self._available_models is None:
+            self._available_models = sorted(
+                f.rsplit('.', 1)[0] for f in os.listdir(self.model_location) if f.endswith('.joblib')
+            )
+        return self._available_models
+
+    def is_available(self, model_name : str) -> bool:
+        return model_name in self.available_models()
+
+    def get(self, model_name : str):
+        '''
+        Returns the loaded pipeline for model_name, loading it the first time it is asked for.
+        Two threads asking for the same model at the same time will only load it once.
+        '''
+        model = self._models.get(model_name)
+        if model is not None:
+            return model
+
+        if not self.is_available(model_name):
+            raise Exception(f'No model available for {model_name}.')
+
+        with self._lock:
+            model_lock = self._model_locks.setdefault(model_name, threading.Lock())
+
+        with model_lock:
+            if model_name not in self._models:
+                self._models[model_name] = self.loader(model_name)
+            return self._models[model_name]
+
+    def is_loaded(self, model_name : str) -> bool:
+        return model_name in self._models
+
+    def warm_up(self) -> None:
+        '''
+        Loads every available model and runs a prediction through it, so the first real request does not pay for
+        the joblib.load, TF graph tracing, etc.
+        '''
+        for model_name in self.available_models():
+            predict_rows(self.get(model_name), [warm_up_row()])
+
+    def clear(self) -> None:
+        '''
+        Drops everything that has been loaded, and forgets what is available on disk.
+        '''
+        with self._lock:
+            self._models = {}
+            self._available_models = None
+
+# One per worker process, this is what the app uses.
+model_registry = ModelRegistry()
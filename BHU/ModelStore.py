@@ -0,0 +1,165 @@
+import os
+import json
+import hashlib
+from typing import List
+
+import numpy as np
+
+from BHU.CompiledEncoder import CompiledFeatureEncoder, CompiledPipeline
+from BHU.NumpyModel import NumpyKerasModel, QuantizedNumpyKerasModel, get_numpy_pipeline_from_file
+
+'''
+joblib/pickle gives every process its own heap copy of every weight matrix. This is an on disk format where the
+arrays are raw bytes in one file that gets np.memmap'ed read only, so every worker on the box shares the same
+page cache pages and loading is basically opening a file.
+
+    BHU/Production_Models/Store/SEATTLE_WA/
+        weights-<hash>.bin  every array back to back, each starting on a 64 byte boundary
+        manifest.json       the encoder and model parameters, with arrays swapped for {"__array__" : i}, and
+                            which weights file they go with
+
+A new version writes a new weights file and then swaps in the manifest, so a reader gets the old manifest with the
+old weights or the new manifest with the new weights, never a mix.
+
+python -m BHU.ModelStore [--precision int8] [MODEL_NAME ...] converts the numpy exports (python -m BHU.NumpyModel).
+'''
+
+MODEL_STORE_LOCATION = 'BHU/Production_Models/Store/'
+STORE_FORMAT = 1
+ALIGNMENT = 64
+
+MODEL_CLASSES = {
+    'NumpyKerasModel' : NumpyKerasModel,
+    'QuantizedNumpyKerasModel' : QuantizedNumpyKerasModel
+}
+
+def model_store_path(model_name : str, precision : str = 'float32', location : str = MODEL_STORE_LOCATION) -> str:
+    if precision == 'float32':
+        return os.path.join(location, model_name)
+    return os.path.join(location, f'{model_name}_{precision}')
+
+def _flatten(value, arrays : List[np.ndarray]):
+    # Swap every array for a reference into arrays, so what is left is plain json.
+    if isinstance(value, np.ndarray):
+        arrays.append(np.ascontiguousarray(value))
+        return {'__array__' : len(arrays) - 1}
+    if isinstance(value, dict):
+        return {k : _flatten(v, arrays) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_flatten(v, arrays) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _unflatten(value, arrays : List[np.ndarray]):
+    if isinstance(value, dict):
+        if set(value) == {'__array__'}:
+            return arrays[value['__array__']]
+        return {k : _unflatten(v, arrays) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_unflatten(v, arrays) for v in value]
+    return value
+
+def save_model_store(model_name : str, pipeline : CompiledPipeline, precision : str = 'float32',
+                     location : str = MODEL_STORE_LOCATION) -> str:
+    '''
+    Writes a CompiledPipeline out as weights-<hash>.bin + manifest.json, returns the directory.
+    '''
+    model = pipeline.model
+    if type(model).__name__ not in MODEL_CLASSES:
+        raise Exception(f'Can not store a {type(model).__name__}, only the numpy models.')
+
+    arrays = []
+    manifest = {
+        'format' : STORE_FORMAT,
+        'model_name' : model_name,
+        'encoder' : _flatten({'columns' : pipeline.encoder.columns, 'blocks' : pipeline.encoder.blocks}, arrays),
+        'model' : {
+            'class' : type(model).__name__,
+            'params' : _flatten(model.get_params(deep=False), arrays)
+        }
+    }
+
+    directory = model_store_path(model_name, precision, location)
+    os.makedirs(directory, exist_ok=True)
+
+    layout, offset = [], 0
+    digest = hashlib.blake2b(digest_size=8)
+    temp_path = os.path.join(directory, f'weights.{os.getpid()}.tmp')
+    with open(temp_path, 'wb') as f:
+        for array in arrays:
+            padding = -offset % ALIGNMENT
+            f.write(b'\0' * padding)
+            digest.update(b'\0' * padding)
+            offset += padding
+            layout.append({'offset' : offset, 'dtype' : array.dtype.str, 'shape' : list(array.shape)})
+            f.write(array.tobytes())
+            digest.update(array.tobytes())
+            offset += array.nbytes
+    manifest['arrays'] = layout
+    manifest['weights'] = f'weights-{digest.hexdigest()}.bin'
+    os.replace(temp_path, os.path.join(directory, manifest['weights']))
+
+    previous = _stored_weights_file(directory)
+    with open(os.path.join(directory, 'manifest.json.tmp'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    # The only swap readers can see. The weights it names are already in place and never change after that.
+    os.replace(os.path.join(directory, 'manifest.json.tmp'), os.path.join(directory, 'manifest.json'))
+
+    # Keep the version before too, for anyone who read the old manifest and has not opened its weights yet.
+    for f in os.listdir(directory):
+        if f.startswith('weights') and f.endswith('.bin') and f not in (manifest['weights'], previous):
+            os.remove(os.path.join(directory, f))
+    return directory
+
+def _stored_weights_file(directory : str) -> str:
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            return json.load(f).get('weights', 'weights.bin')
+    except (OSError, ValueError):
+        return None
+
+def load_model_store(model_name : str, precision : str = 'float32',
+                     location : str = MODEL_STORE_LOCATION) -> CompiledPipeline:
+    '''
+    Opens a stored model. Every array is a read only view into the memory mapped weights file, nothing is copied.
+    '''
+    directory = model_store_path(model_name, precision, location)
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    if manifest.get('format') != STORE_FORMAT:
+        raise Exception(f'{directory} is store format {manifest.get("format")}, expected {STORE_FORMAT}.')
+
+    # Stores written before the weights were versioned do not name theirs.
+    weights_path = os.path.join(directory, manifest.get('weights', 'weights.bin'))
+    weights = np.memmap(weights_path, dtype=np.uint8, mode='r') if os.path.getsize(weights_path) else b''
+    arrays = []
+    for a in manifest['arrays']:
+        dtype = np.dtype(a['dtype'])
+        count = int(np.prod(a['shape'], dtype=np.int64))
+        arrays.append(np.frombuffer(weights, dtype=dtype, count=count, offset=a['offset']).reshape(a['shape']))
+
+    encoder_state = _unflatten(manifest['encoder'], arrays)
+    encoder = CompiledFeatureEncoder(encoder_state['columns'], encoder_state['blocks'])
+    model = MODEL_CLASSES[manifest['model']['class']](**_unflatten(manifest['model']['params'], arrays))
+    return CompiledPipeline(encoder, model)
+
+if __name__ == '__main__':
+    import argparse
+    from BHU.NumpyModel import NUMPY_MODEL_LOCATION, PRECISIONS
+    parser = argparse.ArgumentParser(description='Convert numpy model exports into the memory mapped store.')
+    parser.add_argument('model_names', nargs='*')
+    parser.add_argument('--precision', default='float32', choices=PRECISIONS)
+    args = parser.parse_args()
+
+    model_names = args.model_names
+    if not model_names:
+        exports = [f.rsplit('.', 1)[0] for f in os.listdir(NUMPY_MODEL_LOCATION) if f.endswith('.joblib')]
+        if args.precision == 'float32':
+            model_names = sorted(e for e in exports if not any(e.endswith(f'_{p}') for p in PRECISIONS))
+        else:
+            model_names = sorted(e[:-len(args.precision) - 1] for e in exports if e.endswith(f'_{args.precision}'))
+    for model_name in model_names:
+        directory = save_model_store(model_name, get_numpy_pipeline_from_file(model_name, args.precision), args.precision)
+        print(f'Stored {model_name} in {directory}.')
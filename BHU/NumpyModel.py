@@ -0,0 +1,283 @@
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.pipeline import Pipeline
+from joblib import load, dump
+from typing import List
+
+import numpy as np
+import json
+import os
+
+from BHU.KerasTransformers import get_keras_pipeline_from_file, sample_feature_rows, with_unique_property_ids
+from BHU.CompiledEncoder import CompiledPipeline, compile_pipeline
+
+NUMPY_MODEL_LOCATION = 'BHU/Production_Models/Numpy/'
+MODEL_PRECISION = os.environ.get('BHU_MODEL_PRECISION', 'float32')
+PRECISIONS = ['float32', 'float16', 'int8']
+
+ACTIVATIONS = {
+    'relu' : lambda x: np.maximum(x, 0, out=x),
+    'linear' : lambda x: x
+}
+
+class NumpyKerasModel(BaseEstimator, RegressorMixin):
+    '''
+    At serve time all we ever do with the KerasModel is a forward pass, and that is just a few matrix multiplies.
+    This holds the Dense weights pulled out of a trained KerasModel and runs the same math with numpy, so a worker
+    never has to import TensorFlow, Keras or scikeras to make a prediction.
+
+    It drops into the pipeline exactly where the KerasModel was, so KerasModelToggle does not know the difference.
+    There is no training here, train the KerasModel and export it.
+    '''
+    def __init__(self,
+                 model_name : str,
+                 coefs : List[np.ndarray] = None,
+                 intercepts : List[np.ndarray] = None,
+                 activations : List[str] = None,
+                 target_mean : np.ndarray = None,
+                 target_scale : np.ndarray = None):
+        self.model_name = model_name
+        self.coefs = coefs
+        self.intercepts = intercepts
+        self.activations = activations
+        self.target_mean = target_mean
+        self.target_scale = target_scale
+
+    @classmethod
+    def from_keras_model(cls, keras_model):
+        '''
+        keras_model is the fitted KerasModel step of a pipeline (pipeline.named_steps['keras_model']).
+        '''
+        coefs, intercepts, activations = [], [], []
+        for layer in keras_model.model.model_.layers:
+            kernel, bias = layer.get_weights()
+            coefs.append(np.asarray(kernel, dtype=np.float32))
+            intercepts.append(np.asarray(bias, dtype=np.float32))
+            activations.append(layer.get_config()['activation'])
+
+        unknown = set(activations) - set(ACTIVATIONS)
+        if unknown:
+            raise Exception(f'No numpy version of activation(s): {", ".join(sorted(unknown))}.')
+
+        target_transformer = keras_model.target_transformer
+        return cls(
+            model_name=keras_model.model_name,
+            coefs=coefs,
+            intercepts=intercepts,
+            activations=activations,
+            target_mean=getattr(target_transformer, 'mean_', None),
+            target_scale=getattr(target_transformer, 'scale_', None)
+        )
+
+    def fit(self, X=None, y=None):
+        # Same deal as KerasModel, this will never be hit in production.
+        if self.coefs is None:
+            raise Exception('NumpyKerasModel has to be exported from a trained KerasModel.')
+        return self
+
+    def forward(self, X) -> np.ndarray:
+        '''
+        The raw network output, before the target transformer is undone.
+        '''
+        if hasattr(X, 'toarray'):
+            X = X.toarray()
+        out = np.asarray(X, dtype=np.float32)
+        for W, b, activation in zip(self.coefs, self.intercepts, self.activations):
+            out = out @ W
+            out += b
+            out = ACTIVATIONS[activation](out)
+        return out
+
+    def predict(self, X) -> np.ndarray:
+        # Mirrors StandardScaler.inverse_transform, in place on the float32 output.
+        y = self.forward(X)
+        if self.target_scale is not None:
+            y *= self.target_scale
+        if self.target_mean is not None:
+            y += self.target_mean
+        return y
+
+class QuantizedNumpyKerasModel(NumpyKerasModel):
+    '''
+    Same forward pass, but the Dense weights are kept as float16, or int8 with a scale per output unit, which is
+    half or a quarter of the memory per city. Biases are tiny so they stay float32. The weights are only turned
+    back into float32 one layer at a time inside forward, so they never all sit in memory at full size.
+    '''
+    def __init__(self,
+                 model_name : str,
+                 coefs : List[np.ndarray] = None,
+                 intercepts : List[np.ndarray] = None,
+                 activations : List[str] = None,
+                 target_mean : np.ndarray = None,
+                 target_scale : np.ndarray = None,
+                 precision : str = 'int8',
+                 coef_scales : List[np.ndarray] = None):
+        super().__init__(model_name, coefs, intercepts, activations, target_mean, target_scale)
+        self.precision = precision
+        self.coef_scales = coef_scales
+
+    @classmethod
+    def from_numpy_model(cls, model : NumpyKerasModel, precision : str = 'int8'):
+        if precision not in ['float16', 'int8']:
+            raise Exception(f'Can not quantize to {precision}, only float16 or int8.')
+
+        coefs, coef_scales = [], []
+        for W in model.coefs:
+            if precision == 'float16':
+                coefs.append(W.astype(np.float16))
+                coef_scales.append(None)
+                continue
+            # Symmetric, per output unit (column), so one big weight does not flatten the rest of the layer.
+            scale = np.abs(W).max(axis=0) / 127
+            scale[scale == 0] = 1
+            coefs.append(np.clip(np.round(W / scale), -127, 127).astype(np.int8))
+            coef_scales.append(scale.astype(np.float32))
+
+        return cls(
+            model_name=model.model_name,
+            coefs=coefs,
+            intercepts=model.intercepts,
+            activations=model.activations,
+            target_mean=model.target_mean,
+            target_scale=model.target_scale,
+            precision=precision,
+            coef_scales=coef_scales
+        )
+
+    def forward(self, X) -> np.ndarray:
+        if hasattr(X, 'toarray'):
+            X = X.toarray()
+        out = np.asarray(X, dtype=np.float32)
+        for W, scale, b, activation in zip(self.coefs, self.coef_scales, self.intercepts, self.activations):
+            out = out @ W.astype(np.float32)
+            if scale is not None:
+                out *= scale
+            out += b
+            out = ACTIVATIONS[activation](out)
+        return out
+
+def numpy_model_file_path(model_name : str, precision : str = 'float32') -> str:
+    if precision == 'float32':
+        return f'{NUMPY_MODEL_LOCATION}{model_name}.joblib'
+    return f'{NUMPY_MODEL_LOCATION}{model_name}_{precision}.joblib'
+
+def get_numpy_pipeline_from_file(model_name : str, precision : str = 'float32') -> CompiledPipeline:
+    return load(numpy_model_file_path(model_name, precision))
+
+def quantize_pipeline(pipeline : CompiledPipeline, precision : str) -> CompiledPipeline:
+    return CompiledPipeline(pipeline.encoder, QuantizedNumpyKerasModel.from_numpy_model(pipeline.model, precision))
+
+def quantization_report(float_pipeline, quantized_pipeline, X : List[dict], y : List[float] = None) -> dict:
+    '''
+    How much the quantized model moves the predictions on X. If the real prices y are passed, also how far off
+    each model is from them.
+    '''
+    X = with_unique_property_ids(X)
+    float_preds = np.asarray(float_pipeline.predict(X), dtype=np.float64).reshape(-1)
+    quantized_preds = np.asarray(quantized_pipeline.predict(X), dtype=np.float64).reshape(-1)
+    delta = np.abs(quantized_preds - float_preds)
+
+    report = {
+        'n_rows' : len(X),
+        'mean_abs_delta' : float(delta.mean()),
+        'max_abs_delta' : float(delta.max()),
+        'mean_abs_pct_delta' : float((delta / np.maximum(np.abs(float_preds), 1e-12)).mean() * 100)
+    }
+
+    if y is not None:
+        y = np.asarray(y, dtype=np.float64).reshape(-1)
+        report['mae_float32'] = float(np.abs(float_preds - y).mean())
+        report['mae_quantized'] = float(np.abs(quantized_preds - y).mean())
+    return report
+
+def to_numpy_pipeline(pipeline : Pipeline) -> Pipeline:
+    '''
+    Same preprocessing steps, KerasModel swapped for NumpyKerasModel.
+    '''
+    numpy_model = NumpyKerasModel.from_keras_model(pipeline.named_steps['keras_model'])
+    return Pipeline(pipeline.steps[:-1] + [('numpy_model', numpy_model)])
+
+def verify_numpy_pipeline(keras_pipeline : Pipeline, numpy_pipeline, X : List[dict],
+                          rtol : float = 1e-5) -> float:
+    '''
+    Runs X through both pipelines and blows up if they do not agree. Returns the worst relative difference.
+    '''
+    X = with_unique_property_ids(X)
+    keras_preds = np.asarray(keras_pipeline.predict(X), dtype=np.float64).reshape(-1)
+    numpy_preds = np.asarray(numpy_pipeline.predict(X), dtype=np.float64).reshape(-1)
+
+    if keras_preds.shape != numpy_preds.shape:
+        raise Exception(f'Prediction shapes do not match: {keras_preds.shape} vs {numpy_preds.shape}.')
+
+    worst = float(np.max(np.abs(keras_preds - numpy_preds) / np.maximum(np.abs(keras_preds), 1e-12)))
+    if worst > rtol:
+        raise Exception(f'Numpy model is off from the Keras model by up to {worst:.2e} (allowed {rtol:.0e}).')
+    return worst
+
+def export_numpy_pipeline(model_name : str, pipeline : Pipeline = None, X : List[dict] = None,
+                          rtol : float = 1e-5, precision : str = 'float32',
+                          X_holdout : List[dict] = None, y_holdout : List[float] = None) -> CompiledPipeline:
+    '''
+    Pulls the weights out of a production Keras pipeline, compiles the preprocessing, and saves the result next
+    to it. The checks against the Keras pipeline are done on X, or the held out rows if X is not passed, or rows
+    sampled from the fitted preprocessing if there are neither.
+
+    X_holdout / y_holdout are real houses and their prices (ie FeatureGenerator's features and targets for a city
+    the model was not fit on). With them, or with precision float16 or int8, a report is saved next to the export
+    as json: how far quantizing moved the predictions, and with y_holdout how far each model is from the real
+    prices. Without a held out set the report is on X, and only says how far the predictions moved.
+    '''
+    if precision not in PRECISIONS:
+        raise Exception(f'Precision must be one of {", ".join(PRECISIONS)}.')
+    if pipeline is None:
+        pipeline = get_keras_pipeline_from_file(model_name)
+    if X is None:
+        X = sample_feature_rows(pipeline) if X_holdout is None else X_holdout
+
+    numpy_pipeline = to_numpy_pipeline(pipeline)
+    compiled_pipeline = compile_pipeline(numpy_pipeline, X)
+    worst = verify_numpy_pipeline(pipeline, compiled_pipeline, X, rtol)
+
+    report = None
+    if precision != 'float32' or y_holdout is not None:
+        float_pipeline = compiled_pipeline
+        if precision != 'float32':
+            compiled_pipeline = quantize_pipeline(float_pipeline, precision)
+        report = quantization_report(float_pipeline, compiled_pipeline,
+                                     X if X_holdout is None else X_holdout, y_holdout)
+        report['precision'] = precision
+        report['holdout'] = X_holdout is not None
+        compiled_pipeline.model.accuracy_report_ = report
+
+    os.makedirs(NUMPY_MODEL_LOCATION, exist_ok=True)
+    dump(compiled_pipeline, numpy_model_file_path(model_name, precision), compress=3)
+    if report is not None:
+        with open(numpy_model_file_path(model_name, precision).replace('.joblib', '.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print(f'Exported {model_name} ({precision}), worst relative difference {worst:.2e} over {len(X)} rows.')
+    if report is not None:
+        print(f'    mean prediction change {report["mean_abs_pct_delta"]:.3f}% over {report["n_rows"]} '
+              f'{"held out" if report["holdout"] else "sampled"} rows' +
+              (f', MAE {report["mae_float32"]:,.0f} float32 / {report["mae_quantized"]:,.0f} {precision}.'
+               if 'mae_float32' in report else '.'))
+    return compiled_pipeline
+
+if __name__ == '__main__':
+    # python -m BHU.NumpyModel [--precision int8] [--holdout "holdout/{model_name}.joblib"] [MODEL_NAME ...],
+    # defaults to every production pipeline.
+    import argparse
+    from BHU.ModelRegistry import MODEL_LOCATION
+    parser = argparse.ArgumentParser(description='Export production pipelines to numpy.')
+    parser.add_argument('model_names', nargs='*')
+    parser.add_argument('--precision', default='float32', choices=PRECISIONS)
+    parser.add_argument('--holdout', default=None,
+                        help='joblib file of (X, y), feature dicts and prices. {model_name} is filled in per model.')
+    args = parser.parse_args()
+
+    model_names = args.model_names or sorted(f.rsplit('.', 1)[0] for f in os.listdir(MODEL_LOCATION)
+                                             if f.endswith('.joblib'))
+    for model_name in model_names:
+        X_holdout, y_holdout = None, None
+        if args.holdout is not None:
+            X_holdout, y_holdout = load(args.holdout.format(model_name=model_name))
+        export_numpy_pipeline(model_name, precision=args.precision, X_holdout=X_holdout, y_holdout=y_holdout)
@@ -0,0 +1,129 @@
+import os
+import json
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+
+from BHU.KerasTransformers import MODEL_FEATURE_COLUMNS, predict_rows
+
+PREDICTION_CACHE_SIZE = int(os.environ.get('BHU_PREDICTION_CACHE_SIZE', 4096))
+
+def _canonical_value(value):
+    # True, 1, 1.0 and numpy's versions of them are all the same thing to the model.
+    if value is None:
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return None if math.isnan(value) else value
+
+def canonical_feature_hash(features : dict, columns : List[str] = MODEL_FEATURE_COLUMNS) -> str:
+    '''
+    A hash of only the columns the model looks at, so two feature dicts that differ in address, tags, etc. but
+    would get the same prediction hash the same.
+    '''
+    canonical = [_canonical_value(features.get(c)) for c in columns]
+    return hashlib.blake2b(json.dumps(canonical).encode(), digest_size=16).hexdigest()
+
+class PredictionCache():
+    '''
+    People toggle the same few bed/bath/garage combinations over and over, and every submit also re-predicts the
+    unchanged house to get the baseline. This is a bounded LRU of predictions keyed by model name and the
+    canonical hash of the model columns, so repeats never make it to the model.
+    '''
+    def __init__(self,
+                 maxsize : int = PREDICTION_CACHE_SIZE
+                 ):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._cache : OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f'Prediction cache, {len(self._cache)} of {self.maxsize} entries.'
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def key(self, model_name : str, features : dict) -> tuple:
+        return (model_name, canonical_feature_hash(features))
+
+    def get(self, key : tuple) -> float:
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key : tuple, value : float) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def predict(self, model_name : str, model, rows : List[dict]) -> np.ndarray:
+        '''
+        One prediction per row as a flat array. Only the rows not already cached go to the model, in one call.
+        '''
+        keys = [self.key(model_name, r) for r in rows]
+        values = [self.get(k) for k in keys]
+
+        missing = [i for i, v in enumerate(values) if v is None]
+        if len(missing):
+            predictions = predict_rows(model, [rows[i] for i in missing])
+            for i, p in zip(missing, predictions):
+                values[i] = float(p)
+                self.put(keys[i], values[i])
+
+        return np.array(values, dtype=float)
+
+    def wrap(self, model_name : str, model):
+        '''
+        Something with a predict that can be handed to KerasModelToggle in place of the pipeline.
+        '''
+        return CachedModel(self, model_name, model)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries' : len(self._cache),
+            'maxsize' : self.maxsize,
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'hit_rate' : self.hits / lookups if lookups else 0.0
+        }
+
+class CachedModel():
+    '''
+    Looks like a pipeline (predict returns one row per input, one column), but checks the cache first.
+    '''
+    def __init__(self,
+                 cache : PredictionCache,
+                 model_name : str,
+                 model):
+        self.cache = cache
+        self.model_name = model_name
+        self.model = model
+
+    def __repr__(self) -> str:
+        return f'Cached {self.model_name} model.'
+
+    def predict(self, X : List[dict]) -> np.ndarray:
+        return self.cache.predict(self.model_name, self.model, list(X)).reshape(-1, 1)
@@ -0,0 +1,117 @@
+import os
+import threading
+from typing import Dict, List
+
+import numpy as np
+
+from BHU.KerasTransformers import predict_rows
+from BHU.ModelRegistry import model_registry
+
+# Off unless asked for, on a sync worker the window is only added latency.
+BATCH_WINDOW_MS = float(os.environ.get('BHU_BATCH_WINDOW_MS', 0))
+MAX_BATCH_SIZE = int(os.environ.get('BHU_MAX_BATCH_SIZE', 64))
+
+class _Batch():
+    def __init__(self):
+        self.rows : List[dict] = []
+        self.results : np.ndarray = None
+        self.error : Exception = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+class PredictionDispatcher():
+    '''
+    When a bunch of people hit submit on the toggle page at once, each request was doing its own one row predict.
+    A forward pass on 50 rows costs about the same as on one, so this sits in front of the models and lumps
+    together whatever shows up for the same city within a short window (or until the batch is full), runs one
+    predict, and hands each caller back their own rows.
+
+    There is no background thread. The first request into an empty batch waits out the window and then runs the
+    batch for everyone who joined it. This only helps when a worker serves requests on more than one thread
+    (gunicorn --threads), otherwise there is never anyone to batch with. So the window is 0 (every request runs on
+    its own, straight away) unless BHU_BATCH_WINDOW_MS is set, a few ms is plenty on a threaded worker.
+    '''
+    def __init__(self,
+                 registry = model_registry,
+                 window_ms : float = BATCH_WINDOW_MS,
+                 max_batch_size : int = MAX_BATCH_SIZE
+                 ):
+        self.registry = registry
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+
+        self._lock = threading.Lock()
+        self._open : Dict[str, _Batch] = {}
+        self.n_batches = 0
+        self.n_rows = 0
+
+    def __repr__(self) -> str:
+        return f'Prediction dispatcher, {self.window * 1000:g} ms window, batches of up to {self.max_batch_size}.'
+
+    def model(self, model_name : str):
+        '''
+        Something with a predict that can be handed to KerasModelToggle in place of the pipeline.
+        '''
+        return BatchedModel(self, model_name)
+
+    def predict(self, model_name : str, rows : List[dict]) -> np.ndarray:
+        '''
+        Returns one prediction per row, as a flat array.
+        '''
+        with self._lock:
+            batch = self._open.get(model_name)
+            leader = batch is None
+            if leader:
+                batch = _Batch()
+                self._open[model_name] = batch
+            start = len(batch.rows)
+            batch.rows.extend(rows)
+            end = len(batch.rows)
+            if end >= self.max_batch_size:
+                # Nobody else gets in, and the leader does not need to wait out the window.
+                del self._open[model_name]
+                batch.full.set()
+
+        if leader:
+            if self.window > 0:
+                batch.full.wait(self.window)
+            with self._lock:
+                if self._open.get(model_name) is batch:
+                    del self._open[model_name]
+                self.n_batches += 1
+                self.n_rows += len(batch.rows)
+            try:
+                batch.results = predict_rows(self.registry.get(model_name), batch.rows)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[start:end]
+
+    def stats(self) -> dict:
+        return {
+            'batches' : self.n_batches,
+            'rows' : self.n_rows,
+            'mean_batch_size' : self.n_rows / self.n_batches if self.n_batches else 0.0
+        }
+
+class BatchedModel():
+    '''
+    Looks like a pipeline (predict returns one row per input, one column), but goes through the dispatcher.
+    '''
+    def __init__(self,
+                 dispatcher : PredictionDispatcher,
+                 model_name : str):
+        self.dispatcher = dispatcher
+        self.model_name = model_name
+
+    def __repr__(self) -> str:
+        return f'Batched {self.model_name} model.'
+
+    def predict(self, X : List[dict]) -> np.ndarray:
+        return self.dispatcher.predict(self.model_name, list(X)).reshape(-1, 1)
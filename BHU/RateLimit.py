@@ -0,0 +1,174 @@
+import os
+import time
+import struct
+import asyncio
+import threading
+import contextlib
+import weakref
+from urllib.parse import urlsplit
+
+try:
+    import fcntl
+except ImportError: # Windows, buckets are per process there.
+    fcntl = None
+
+'''
+Token buckets for the upstream APIs, so however many threads or coroutines are making calls we stay inside our
+quotas instead of finding out about them from a 429. A bucket holds up to burst tokens and refills at rate tokens a
+second, every call takes one.
+
+The bucket state lives in a small file per host under BHU_RATE_LIMIT_DIR, read and written under an flock, so every
+process on the machine (gunicorn workers, Ingestion, a bulk job) draws from the same budget instead of each getting
+its own. The rates are for the whole machine, do not divide them by the number of workers.
+
+    BHU_RAPIDAPI_RATE / BHU_RAPIDAPI_BURST      us-real-estate.p.rapidapi.com
+    BHU_WALKSCORE_RATE / BHU_WALKSCORE_BURST    api.walkscore.com
+
+The default of 5 a second is a conservative placeholder, not anyone's real quota. Set these from the rate limit on
+the RapidAPI plan the USRealEstate key is on and on the Walk Score key.
+
+A blocking caller waits at most BHU_RATE_LIMIT_MAX_WAIT seconds for its token. If the bucket is further behind than
+that it gets a RateLimited straight away (and takes nothing), rather than holding a Flask request thread asleep.
+Batch jobs that would rather wait can raise it. The coroutines in AsyncAPI_Calls wait too, but only ever take a
+token that is there, so they use what is left over rather than queueing up ahead of the web requests.
+'''
+
+RAPIDAPI_RATE = float(os.environ.get('BHU_RAPIDAPI_RATE', 5))
+RAPIDAPI_BURST = int(os.environ.get('BHU_RAPIDAPI_BURST', 5))
+WALKSCORE_RATE = float(os.environ.get('BHU_WALKSCORE_RATE', 5))
+WALKSCORE_BURST = int(os.environ.get('BHU_WALKSCORE_BURST', 5))
+RATE_LIMIT_DIR = os.environ.get('BHU_RATE_LIMIT_DIR', 'BHU/Saved Results/RateLimits/')
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('BHU_RATE_LIMIT_MAX_WAIT', 2))
+
+# tokens, when they were counted (time.time(), since it has to mean the same thing in every process)
+_STATE = struct.Struct('!dd')
+
+class RateLimited(Exception):
+    def __init__(self, message : str, wait : float = None):
+        super().__init__(message)
+        # How far behind the bucket was, in seconds.
+        self.wait = wait
+
+class TokenBucket():
+    '''
+    Instead of waiting for a token to show up, a blocking caller takes one straight away (the count can go
+    negative, up to max_wait seconds of debt) and then sleeps off the debt. That way the bookkeeping is a few lines
+    under a lock and callers get served in the order they asked. Coroutines only take tokens that are there, see
+    acquire_async.
+    With a state_path the count is kept in that file instead of on the object, and shared by every process using it.
+    '''
+    def __init__(self,
+                 rate : float,
+                 burst : int = 1,
+                 state_path : str = None):
+        if rate <= 0:
+            raise Exception('Token bucket rate must be positive.')
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.state_path = state_path if fcntl is not None else None
+
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+        self._waited = 0.0
+        self._calls = 0
+        self._refused = 0
+        # One coroutine per event loop polls the bucket at a time, the rest queue behind it.
+        self._async_locks = weakref.WeakKeyDictionary()
+
+    def __repr__(self) -> str:
+        return f'Token bucket, {self.rate}/s with a burst of {self.burst}.'
+
+    @contextlib.contextmanager
+    def _state(self):
+        # Yields [tokens, updated], whatever is in it at the end is written back.
+        if self.state_path is None:
+            state = [self._tokens, self._updated]
+            yield state
+            self._tokens, self._updated = state
+            return
+
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, _STATE.size, 0)
+            state = list(_STATE.unpack(data)) if len(data) == _STATE.size else [float(self.burst), time.time()]
+            yield state
+            os.pwrite(fd, _STATE.pack(*state), 0)
+        finally:
+            os.close(fd)
+
+    def _reserve(self, tokens : int, max_wait : float = None) -> float:
+        # Seconds the caller has to wait before its tokens are really there.
+        with self._lock, self._state() as state:
+            now = time.time()
+            available = min(self.burst, state[0] + max(0.0, now - state[1]) * self.rate) - tokens
+            wait = max(0.0, -available / self.rate)
+            if max_wait is not None and wait > max_wait:
+                raise RateLimited(f'{self.state_path or "Rate limit"} is {wait:.1f}s behind, '
+                                  f'more than the {max_wait}s we wait.', wait)
+            state[0], state[1] = available, now
+            self._waited += wait
+            self._calls += 1
+            return wait
+
+    def acquire(self, tokens : int = 1, max_wait : float = RATE_LIMIT_MAX_WAIT) -> None:
+        '''
+        Raises RateLimited instead of waiting more than max_wait seconds, None waits however long it takes.
+        '''
+        try:
+            wait = self._reserve(tokens, max_wait)
+        except RateLimited:
+            with self._lock:
+                self._refused += 1
+            raise
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens : int = 1, max_wait : float = 0.0) -> None:
+        '''
+        Never books more than max_wait ahead (by default, only takes tokens that are there right now), and otherwise
+        sleeps until they should be and tries again. A batch job holds no backlog in the bucket that way, so the
+        blocking callers sharing it are not refused because of it. The locking is done off the event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        lock = self._async_locks.get(loop)
+        if lock is None:
+            lock = self._async_locks[loop] = asyncio.Lock()
+
+        async with lock:
+            while True:
+                try:
+                    wait = await loop.run_in_executor(None, self._reserve, tokens, max_wait)
+                    break
+                except RateLimited as e:
+                    await asyncio.sleep(max(e.wait - max_wait, 0.01))
+        if wait:
+            await asyncio.sleep(wait)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'rate' : self.rate, 'burst' : self.burst, 'calls' : self._calls, 'waited' : round(self._waited, 3),
+                    'refused' : self._refused, 'shared' : self.state_path is not None}
+
+def _state_path(host : str) -> str:
+    return os.path.join(RATE_LIMIT_DIR, host)
+
+rate_limiters = {
+    'us-real-estate.p.rapidapi.com' : TokenBucket(RAPIDAPI_RATE, RAPIDAPI_BURST,
+                                                  _state_path('us-real-estate.p.rapidapi.com')),
+    'api.walkscore.com' : TokenBucket(WALKSCORE_RATE, WALKSCORE_BURST, _state_path('api.walkscore.com'))
+}
+
+def rate_limiter(url : str) -> TokenBucket:
+    '''
+    The bucket for the host in url. Anything we do not have a quota for gets its own, generously sized, bucket.
+    '''
+    host = urlsplit(url).netloc
+    limiter = rate_limiters.get(host)
+    if limiter is None:
+        limiter = rate_limiters.setdefault(host, TokenBucket(RAPIDAPI_RATE * 10, RAPIDAPI_BURST * 10, _state_path(host)))
+    return limiter
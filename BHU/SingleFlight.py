@@ -0,0 +1,112 @@
+import os
+import copy
+import hashlib
+import functools
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError: # Windows, file_lock does not lock anything there.
+    fcntl = None
+
+'''
+When a listing gets popular a lot of people look up the same property at the same time, and every one of those
+requests used to go to the API on its own. With @single_flight, callers asking for the same function with the same
+arguments while a call is already running wait for that call and get its result instead of making their own.
+
+This is in process only. Between gunicorn workers the checkpoint cache does the same job in shared mode (a lock per
+key, and whoever waited reads what the first worker cached), see BHU.Checkpoint.
+'''
+
+@contextlib.contextmanager
+def file_lock(path : str, blocking : bool = True):
+    '''
+    Exclusive flock on path (created if it is not there), yields whether we got it. Without blocking, we give up
+    straight away if someone else has it. Where there is no fcntl this does not lock anything and always yields True.
+    '''
+    if fcntl is None:
+        yield True
+        return
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a+b') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def call_key(func, args : tuple, kwargs : dict) -> str:
+    signature = repr((func.__module__, func.__qualname__, args, sorted(kwargs.items())))
+    return hashlib.blake2b(signature.encode('utf-8'), digest_size=16).hexdigest()
+
+class _Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error : BaseException = None
+
+class SingleFlight():
+    '''
+    The in process part. The first caller for a key runs the function, everyone else who shows up before it is
+    done waits for it and gets the same result (or the same exception). Waiters get their own deep copy, the results
+    are API response dicts that get changed by whoever holds them, same reason bhu_checkpoint unpickles per caller.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._shared = 0
+
+    def __repr__(self) -> str:
+        return f'Single flight, {len(self._calls)} calls in flight.'
+
+    def do(self, key : str, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self._shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'in_flight' : len(self._calls), 'shared' : self._shared}
+
+single_flight_group = SingleFlight()
+
+def single_flight(group : SingleFlight = single_flight_group):
+    '''
+    Decorator, see the top of the file. Goes outside of bhu_checkpoint, so a caller that waited is not also
+    reading and writing the same checkpoint file at the same time as the one making the call.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            return group.do(call_key(func, args, kwargs), func, *args, **kwargs)
+        return wrapped
+    return decorator
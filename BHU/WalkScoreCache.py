@@ -0,0 +1,214 @@
+import os
+import copy
+import logging
+import threading
+import contextlib
+from collections import OrderedDict
+from typing import List, Tuple
+
+from retrying import retry
+
+from BHU.API_Calls import get_WalkScore, _walk_score_request, _http_get, _retry_unless_rate_limited, \
+    CHECKPOINT_TTL, CHECKPOINT_MAX_BYTES
+from BHU.Checkpoint import register_namespace, CHECKPOINT_SHARED
+from BHU.Codecs import checkpoint_codec
+from BHU.SingleFlight import single_flight_group
+
+'''
+get_WalkScore is checkpointed on the exact lat/lon, so two houses on the same block are two API calls. Walk score
+barely moves within a block, so this caches it by geohash cell instead. A lookup checks the cell the point is in,
+then the 8 cells around it, and only goes to the API if none of them have a score.
+
+Precision 7 cells are about 150m x 150m, 6 is about 1.2km x 600m. BHU_WALK_SCORE_GEOHASH_PRECISION changes it, and
+since the precision is part of the directory, changing it starts a new cache instead of mixing cell sizes.
+
+Cells are stored as a checkpoint namespace (BHU/Saved Results/WalkScoreGrid/<precision>/), so they get the same
+ttl and size budget as the WalkScore checkpoints, the checksum, the codec and the cross process lock. Before going
+to the API, a miss looks for a score already checkpointed on the exact lat/lon, so nothing fetched before the grid
+existed gets fetched again. The most recently used BHU_WALK_SCORE_CELLS_IN_MEMORY cells are also kept in memory.
+'''
+
+WALK_SCORE_GRID_LOCATION = 'BHU/Saved Results/WalkScoreGrid/'
+WALK_SCORE_GEOHASH_PRECISION = int(os.environ.get('BHU_WALK_SCORE_GEOHASH_PRECISION', 7))
+WALK_SCORE_CELLS_IN_MEMORY = int(os.environ.get('BHU_WALK_SCORE_CELLS_IN_MEMORY', 4096))
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def geohash_encode(lat : float, lon : float, precision : int = WALK_SCORE_GEOHASH_PRECISION) -> str:
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash, bits, n_bits, even = [], 0, 0, True
+    while len(geohash) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude.
+        value, bounds = (lon, lon_range) if even else (lat, lat_range)
+        mid = (bounds[0] + bounds[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            bounds[0] = mid
+        else:
+            bits = bits << 1
+            bounds[1] = mid
+        even = not even
+        n_bits += 1
+        if n_bits == 5:
+            geohash.append(_BASE32[bits])
+            bits, n_bits = 0, 0
+    return ''.join(geohash)
+
+def geohash_cell_size(precision : int = WALK_SCORE_GEOHASH_PRECISION) -> Tuple[float, float]:
+    '''
+    (degrees of latitude, degrees of longitude) covered by one cell.
+    '''
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+def geohash_neighbors(lat : float, lon : float, precision : int = WALK_SCORE_GEOHASH_PRECISION) -> List[str]:
+    '''
+    The 8 cells around the one (lat, lon) is in, found by stepping a cell in each direction from the point.
+    '''
+    lat_step, lon_step = geohash_cell_size(precision)
+    cell = geohash_encode(lat, lon, precision)
+    neighbors = []
+    for d_lat in (-1, 0, 1):
+        for d_lon in (-1, 0, 1):
+            if d_lat == 0 and d_lon == 0:
+                continue
+            n_lat = max(-90.0, min(90.0, lat + d_lat * lat_step))
+            n_lon = (lon + d_lon * lon_step + 180.0) % 360.0 - 180.0
+            neighbor = geohash_encode(n_lat, n_lon, precision)
+            if neighbor != cell and neighbor not in neighbors:
+                neighbors.append(neighbor)
+    return neighbors
+
+@retry(stop_max_attempt_number=5, retry_on_exception=_retry_unless_rate_limited)
+def _request_walk_score(address : str, lat : float, lon : float) -> dict:
+    # Straight to the API, going through get_WalkScore would checkpoint it a second time under the exact lat/lon.
+    # The cell is what gets stored.
+    url, querystring, headers = _walk_score_request(address, lat, lon)
+    return _http_get(url, params=querystring, headers=headers).json()
+
+class WalkScoreCache():
+    '''
+    One checkpoint per cell (the raw walk score response), with the last max_cells cells we touched kept in
+    memory. Misses for the same cell at the same time only make one API call, across processes too if shared.
+    Everyone gets their own copy back, same as coming out of bhu_checkpoint.
+    '''
+    def __init__(self,
+                 precision : int = WALK_SCORE_GEOHASH_PRECISION,
+                 location : str = WALK_SCORE_GRID_LOCATION,
+                 check_neighbors : bool = True,
+                 max_cells : int = WALK_SCORE_CELLS_IN_MEMORY,
+                 shared : bool = CHECKPOINT_SHARED):
+        self.precision = precision
+        self.location = os.path.join(location, str(precision))
+        self.check_neighbors = check_neighbors
+        self.max_cells = max_cells
+        self.shared = shared
+        self.namespace = register_namespace(self.location, ttl=CHECKPOINT_TTL['WalkScore'],
+                                            max_bytes=CHECKPOINT_MAX_BYTES)
+
+        self._cells = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {'hit' : 0, 'neighbor_hit' : 0, 'miss' : 0, 'no_location' : 0}
+
+    def __repr__(self) -> str:
+        return f'Walk score cache, geohash precision {self.precision}.'
+
+    def _count(self, outcome : str) -> None:
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def _cell_key(self, cell : str) -> str:
+        return f'{cell}.pkl'
+
+    def _remember(self, cell : str, walk_score : dict) -> None:
+        with self._lock:
+            self._cells[cell] = walk_score
+            self._cells.move_to_end(cell)
+            while len(self._cells) > self.max_cells:
+                self._cells.popitem(last=False)
+
+    def _read_cell(self, cell : str) -> dict:
+        with self._lock:
+            walk_score = self._cells.get(cell)
+            if walk_score is not None:
+                self._cells.move_to_end(cell)
+                return walk_score
+        # Same as bhu_checkpoint, anything wrong with what is stored is a miss.
+        try:
+            data = self.namespace.get(self._cell_key(cell))
+            if data is None:
+                return None
+            walk_score = checkpoint_codec.loads(data)
+        except Exception as e:
+            logging.warning('Walk score cell %s could not be read: %s', cell, e)
+            return None
+        self._remember(cell, walk_score)
+        return walk_score
+
+    def _write_cell(self, cell : str, walk_score : dict) -> None:
+        self._remember(cell, walk_score)
+        try:
+            self.namespace.put(self._cell_key(cell), checkpoint_codec.dumps(walk_score))
+        except Exception:
+            logging.exception('Walk score cell %s could not be saved.', cell)
+
+    def _fetch_cell(self, cell : str, address : str, lat : float, lon : float) -> dict:
+        lock = self.namespace.key_lock(self._cell_key(cell)) if self.shared else contextlib.nullcontext()
+        with lock:
+            # Someone may have filled it while we were waiting our turn.
+            walk_score = self._read_cell(cell)
+            if walk_score is not None:
+                return walk_score
+
+            found, walk_score = get_WalkScore.cached(address=address, lat=lat, lon=lon)
+            if not found:
+                walk_score = _request_walk_score(address, lat, lon)
+            # Only keep real answers, so a bad response does not get served to the whole block.
+            if walk_score.get('walkscore') is not None:
+                self._write_cell(cell, walk_score)
+            return walk_score
+
+    def get(self, address : str, lat : float, lon : float) -> dict:
+        '''
+        Same arguments and return as get_WalkScore.
+        '''
+        return copy.deepcopy(self._get(address, lat, lon))
+
+    def _get(self, address : str, lat : float, lon : float) -> dict:
+        if lat is None or lon is None:
+            self._count('no_location')
+            return get_WalkScore(address=address, lat=lat, lon=lon)
+
+        cell = geohash_encode(lat, lon, self.precision)
+        walk_score = self._read_cell(cell)
+        if walk_score is not None:
+            self._count('hit')
+            return walk_score
+
+        if self.check_neighbors:
+            for neighbor in geohash_neighbors(lat, lon, self.precision):
+                walk_score = self._read_cell(neighbor)
+                if walk_score is not None:
+                    self._count('neighbor_hit')
+                    return walk_score
+
+        self._count('miss')
+        return single_flight_group.do(f'walk_score_cell_{self.precision}_{cell}',
+                                      self._fetch_cell, cell, address, lat, lon)
+
+    def report(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+            cells_in_memory = len(self._cells)
+        lookups = sum(counts.values())
+        hits = counts['hit'] + counts['neighbor_hit']
+        return {
+            'precision' : self.precision,
+            'lookups' : lookups,
+            **counts,
+            'hit_rate' : round(hits / lookups, 4) if lookups else None,
+            'cells_in_memory' : cells_in_memory
+        }
+
+walk_score_cache = WalkScoreCache()
@@ -1,16 +1,87 @@
-from BHU.API_Calls import *
-from BHU.FeatureGenerator import FeatureGenerator
-from BHU.House import House
-from BHU.KerasModel import KerasModel
-from BHU.KerasModelToggle import KerasModelToggle
-from BHU.KerasTransformers import *
-from BHU.WalkScoreModel import WalkScoreModel
-from BHU.Checkpoint import bhu_checkpoint
-
-from flask import Flask
+import sys
+import types
+import importlib
+import logging
+import threading
+import time
+
+from flask import Flask, jsonify
 import secrets
 
-def create_app():
+'''
+Nothing heavy gets imported until it is used. `from BHU import create_app` used to pull in TensorFlow, scipy, the
+sklearn ensembles and the API keys before Flask could answer anything. Now each name below loads its module the
+first time it is touched (`from BHU import House` still works the same), and import_report() says what was loaded
+and how long it took.
+'''
+
+_LAZY_MODULES = {
+    'BHU.API_Calls' : ['get_LocationSuggest', 'get_PropertyDetail', 'get_PropertyValue', 'get_WalkScore',
+                       'get_Properties', 'query_url', 'get_UserHome', 'get_HousesOfInterest',
+                       'RESULTS_PER_REQUEST_LIMIT', 'USREALESTATE_API_HEADERS'],
+    'BHU.FeatureGenerator' : ['FeatureGenerator'],
+    'BHU.House' : ['House'],
+    'BHU.KerasModel' : ['KerasModel'],
+    'BHU.KerasModelToggle' : ['KerasModelToggle'],
+    'BHU.KerasTransformers' : ['ToDataFrame', 'DictEncoder', 'generate_keras_pipeline', 'train_keras_pipeline',
+                               'get_keras_pipeline_from_file', 'predict_rows', 'sample_feature_rows',
+                               'with_unique_property_ids', 'MODEL_FEATURE_COLUMNS'],
+    'BHU.WalkScoreModel' : ['WalkScoreModel'],
+    'BHU.Checkpoint' : ['bhu_checkpoint'],
+    'BHU.ModelRegistry' : ['ModelRegistry', 'model_registry'],
+    'BHU.NumpyModel' : ['NumpyKerasModel', 'export_numpy_pipeline'],
+}
+
+_LAZY_NAMES = {name : module for module, names in _LAZY_MODULES.items() for name in names}
+_import_times = {}
+
+__all__ = ['create_app', 'import_report'] + list(_LAZY_NAMES)
+
+class _LazyPackage(types.ModuleType):
+    '''
+    House, KerasModel, ModelRegistry and the rest are named the same as the module they are in. Importing one of
+    those modules directly (`import BHU.House`, or any module doing `from BHU.House import House`) has the import
+    system set BHU.House to the module, which would then shadow the class for good. The eager imports this
+    replaced always left the class there, so when that happens we keep the class instead.
+    '''
+    def __setattr__(self, name, value):
+        if isinstance(value, types.ModuleType) and _LAZY_NAMES.get(name) == value.__name__:
+            value = getattr(value, name, value)
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _LazyPackage
+
+def __getattr__(name):
+    module_name = _LAZY_NAMES.get(name)
+    if module_name is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    started = time.perf_counter()
+    module = importlib.import_module(module_name)
+    if module_name not in _import_times:
+        _import_times[module_name] = time.perf_counter() - started
+        logging.info('BHU lazily imported %s in %.3fs', module_name, _import_times[module_name])
+
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_NAMES))
+
+def import_report() -> dict:
+    '''
+    Seconds spent on each lazy import so far, slowest first. A module that was already imported some other way
+    by the time its name was first used shows up as (close to) zero.
+    '''
+    return dict(sorted(_import_times.items(), key=lambda kv: kv[1], reverse=True))
+
+def create_app(warm_up = None):
+    '''
+    warm_up is anything that needs to happen before this worker should take traffic, ie loading every model and
+    pushing something through it (ModelRegistry.warm_up). It runs in the background so the worker can still
+    answer, and /ready says 503 until it has finished.
+    '''
     app = Flask(__name__)
     app.config['BOOTSTRAP_BOOTSWATCH_THEME'] = 'zephyr'
     app.config['BOOTSTRAP_BTN_STYLE'] = 'primary'
@@ -20,4 +91,30 @@ def create_app():
     app.config['BOOTSTRAP_TABLE_DELETE_TITLE'] = 'Remove'
     app.config['BOOTSTRAP_TABLE_NEW_TITLE'] = 'Create'
     app.secret_key = secrets.token_hex()
-    return app
\ No newline at end of file
+
+    ready = threading.Event()
+    warm_up_status = {'seconds' : None, 'error' : None}
+
+    def run_warm_up():
+        started = time.perf_counter()
+        try:
+            warm_up()
+        except Exception as e:
+            # Stay not ready, a worker that can not load its models should not get traffic.
+            logging.exception('BHU warm up failed.')
+            warm_up_status['error'] = str(e)
+        warm_up_status['seconds'] = round(time.perf_counter() - started, 3)
+        logging.info('BHU warm up finished in %.3fs.', warm_up_status['seconds'])
+        if warm_up_status['error'] is None:
+            ready.set()
+
+    if warm_up is None:
+        ready.set()
+    else:
+        threading.Thread(target=run_warm_up, name='bhu-warm-up', daemon=True).start()
+
+    @app.route('/ready', methods=['GET'])
+    def ready_check():
+        return jsonify(ready=ready.is_set(), **warm_up_status), 200 if ready.is_set() else 503
+
+    return app
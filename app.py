@@ -1,21 +1,35 @@
 #type:ignore
-from flask import render_template, request, url_for, redirect, session, flash
+from flask import render_template, request, url_for, redirect, session, flash, jsonify, abort
+from flask import Response, stream_with_context
 from flask_wtf import FlaskForm
 from wtforms.fields import IntegerField, SubmitField, RadioField, TextAreaField, SelectField
 from flask_bootstrap import Bootstrap5
 import os
-
 from BHU import get_PropertyDetail, House
-from BHU.KerasModelToggle import KerasModelToggle, format_number_as_dollar
+from BHU.KerasModelToggle import KerasModelToggle, format_number_as_dollar, GRID_ATTRIBUTES
 from BHU.API_Calls import get_UserHome
-from BHU.KerasTransformers import get_keras_pipeline_from_file
+from BHU.ModelRegistry import model_registry
+from BHU.PredictionDispatcher import PredictionDispatcher
+from BHU.PredictionCache import PredictionCache
+from BHU.BulkPredict import stream_batch_predictions
+from BHU.InferenceServer import InferenceClient
 
 from BHU import create_app
-app = create_app()
 
 DEBUG = False
+GRID_MAX_COMBINATIONS = 2000
+
+# If there is an inference server running (python -m BHU.InferenceServer), let it own the models.
+model_source = InferenceClient(os.environ['BHU_INFERENCE_SOCKET']) if 'BHU_INFERENCE_SOCKET' in os.environ \
+    else model_registry
+
+# Load and run every model before /ready says this worker can take traffic. BHU_WARM_UP=0 skips it.
+app = create_app(warm_up=model_source.warm_up if os.environ.get('BHU_WARM_UP', '1') != '0' else None)
 
 bootstrap = Bootstrap5(app)
+# The inference server batches what every worker sends it, batching here as well would only add a second window.
+prediction_dispatcher = PredictionDispatcher(model_source) if model_source is model_registry else None
+prediction_cache = PredictionCache()
 
 '''
 GET : This method pulls specific information form the webserver (just to view it)
@@ -87,9 +101,7 @@ def valid_location(session = session):
     city = session.get('user_home', {}).get('city') or ''
     state = session.get('user_home', {}).get('state_code') or ''
     model_code = f'{city.upper()}_{state.upper()}'
-    model_location = 'BHU/Production_Models/Pipeline/'
-    available_models = os.listdir(model_location)
-    valid = model_code + '.joblib' in available_models
+    valid = model_source.is_available(model_code)
     return (valid, city, state)
 
 @app.route('/', methods=['GET', 'POST'])
@@ -279,7 +291,9 @@ def toggle_model():
             flash('All cookies have been cleared. Play again!', 'success')
             return redirect(url_for('main_page'))
         elif request.form.get('submit') == 'Submit':
-            keras_model_toggle = KerasModelToggle(get_keras_pipeline_from_file(session['model_name']),
+            model_name = session['model_name']
+            model = model_source.get(model_name) if prediction_dispatcher is None else prediction_dispatcher.model(model_name)
+            keras_model_toggle = KerasModelToggle(prediction_cache.wrap(model_name, model),
                                                   user_features=session['user_home_features'],
                                                   user_price = session['user_home_price'],
                                                   address=session['user_home_address'])
@@ -314,6 +328,45 @@ def toggle_model():
 
     pass
 
+@app.route('/toggle/grid/', methods=['POST'])
+def toggle_grid():
+    '''
+    Takes a JSON body of attribute -> list of values to try, ie {"beds" : [3, 4, 5], "garage" : [0, 1]},
+    and returns every combination ranked by projected dollar delta. Only works once the user has confirmed
+    their house on the attributes page.
+    '''
+    if 'user_home_features' not in session or 'model_name' not in session:
+        abort(400, 'Confirm your home attributes before running the grid.')
+
+    body = request.get_json(silent=True) or {}
+    try:
+        ranges = {k : [int(v) for v in body[k]] for k in GRID_ATTRIBUTES if body.get(k) is not None}
+        top_n = int(body['top_n']) if body.get('top_n') is not None else None
+    except (TypeError, ValueError):
+        abort(400, 'Grid values must be lists of whole numbers.')
+
+    n_combinations = 1
+    for v in ranges.values():
+        n_combinations *= len(v)
+    if n_combinations > GRID_MAX_COMBINATIONS:
+        abort(400, f'Too many combinations requested ({n_combinations:,}), the limit is {GRID_MAX_COMBINATIONS:,}.')
+
+    keras_model_toggle = KerasModelToggle(model_source.get(session['model_name']),
+                                          user_features=session['user_home_features'],
+                                          user_price = session['user_home_price'],
+                                          address=session['user_home_address'])
+
+    return jsonify(keras_model_toggle.sensitivity_grid(top_n=top_n, **ranges))
+
+@app.route('/api/predict/batch', methods=['POST'])
+def predict_batch():
+    '''
+    Bulk valuation, no session or forms involved. POST JSON Lines, one feature dict per line (with a model_name,
+    or a city and state_code), and get JSON Lines back as each chunk is scored. See BHU.BulkPredict.
+    '''
+    return Response(stream_with_context(stream_batch_predictions(request.stream, model_source)),
+                    mimetype='application/x-ndjson')
+
 @app.route('/about/', methods=['GET'])
 def about_form():
     return render_template('about.html')